@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+import asyncio
+from datetime import datetime, timedelta
+
+from Metrics import REGISTRY
+
+JOB_RUNS = REGISTRY.counter("giornalettiere_scheduler_runs_total", "Scheduled job runs, by outcome", ["job", "outcome"])
+
+
+class AsyncScheduler:
+    """
+    Runs periodic jobs as tasks of the bot event loop.
+    Each job is a coroutine function, awaited at its planned times - A run that lasts past the next planned time
+    delays it instead of overlapping with it
+    """
+
+    MAX_SLEEP = 60
+    """
+    Maximum seconds slept at once, so that wall clock changes (e.g. DST, suspend) are noticed
+    """
+
+    def __init__(self, logging_handler):
+        """
+        Create the scheduler
+        :param logging_handler: A logging instance
+        """
+        self.logging = logging_handler
+        self.jobs = []
+        self.tasks = []
+        self.loop = None
+
+    @staticmethod
+    def parse_time(at):
+        """
+        Parse a daily time
+        :param at: The time in HH:MM format
+        :return: The datetime.time
+        :raise ValueError: If the time is not valid
+        """
+        try:
+            return datetime.strptime(str(at), "%H:%M").time()
+        except ValueError:
+            raise ValueError(f"Invalid time [{at}] - Expected HH:MM") from None
+
+    def every_day_at(self, at, job, name=None):
+        """
+        Run a job every day at the given time (local time)
+        :param at: The time in HH:MM format
+        :param job: The coroutine function to run
+        :param name: The job name, used in logs and metrics
+        :return: None
+        :raise ValueError: If the time is not valid
+        """
+        at_time = self.parse_time(at)
+
+        def next_run(now):
+            planned = datetime.combine(now.date(), at_time)
+            return planned if planned > now else planned + timedelta(days=1)
+
+        self.add(name or f"{getattr(job, '__name__', 'job')}@{at}", job, next_run)
+
+    def every(self, seconds, job, name=None):
+        """
+        Run a job periodically
+        :param seconds: The seconds between the end of a run and the start of the next one
+        :param job: The coroutine function to run
+        :param name: The job name, used in logs and metrics
+        :return: None
+        """
+        self.add(name or getattr(job, '__name__', 'job'), job, lambda now: now + timedelta(seconds=seconds))
+
+    def add(self, name, job, next_run):
+        """
+        Add a job, starting it at once if the scheduler is running
+        :param name: The job name
+        :param job: The coroutine function to run
+        :param next_run: Function returning the next run time after the given datetime
+        :return: None
+        """
+        self.jobs.append((name, job, next_run))
+        self.logging.info(f"AsyncScheduler - Added job [{name}]")
+        if self.loop is not None:
+            self.tasks.append(self.loop.create_task(self.run_job(name, job, next_run), name=name))
+
+    def start(self):
+        """
+        Start all the jobs on the running event loop
+        :return: None
+        """
+        self.loop = asyncio.get_running_loop()
+        for name, job, next_run in self.jobs:
+            self.tasks.append(self.loop.create_task(self.run_job(name, job, next_run), name=name))
+        self.logging.info(f"AsyncScheduler - Started {len(self.jobs)} jobs")
+
+    async def stop(self):
+        """
+        Cancel all the jobs, waiting for them to end
+        :return: None
+        """
+        tasks, self.tasks = self.tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.loop = None
+        self.logging.info("AsyncScheduler - Stopped")
+
+    async def run_job(self, name, job, next_run):
+        """
+        Run a job forever at its planned times
+        :param name: The job name
+        :param job: The coroutine function to run
+        :param next_run: Function returning the next run time after the given datetime
+        :return: None
+        """
+        while True:
+            planned = next_run(datetime.now())
+            while (remaining := (planned - datetime.now()).total_seconds()) > 0:
+                await asyncio.sleep(min(remaining, self.MAX_SLEEP))
+            self.logging.debug(f"AsyncScheduler - Running job [{name}]")
+            try:
+                await job()
+                JOB_RUNS.labels(name, "completed").inc()
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                JOB_RUNS.labels(name, "failed").inc()
+                self.logging.exception(f"AsyncScheduler - Job [{name}] failed [{err}]")
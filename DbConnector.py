@@ -1,83 +1,288 @@
 #!/usr/bin/env python3
 import sqlite3
+import threading
 import os
 
+from Metrics import REGISTRY
+
+DB_SECONDS = REGISTRY.histogram("giornalettiere_db_seconds", "Time spent on each DB operation, waiting for the connection included", ["operation"])
+
 # The main class
 class DbConnector:
-	
+
+	#Statements reused by every call - sqlite3 keeps them prepared in its statement cache
+	INSERT_FILE = "INSERT OR IGNORE INTO files values(?)"
+	REMOVE_FILE = "DELETE FROM files where file_name = ?"
+	SELECT_FILES = "SELECT rowid, file_name FROM files WHERE rowid > ? ORDER BY rowid LIMIT ?"
+	SELECT_FILE_ID = "SELECT file_id FROM file_ids WHERE fingerprint = ? AND kind = ?"
+	INSERT_FILE_ID = "INSERT OR REPLACE INTO file_ids values(?, ?, ?)"
+	REMOVE_FILE_ID = "DELETE FROM file_ids WHERE fingerprint = ? AND kind = ?"
+	SELECT_UPLOAD = "SELECT file_id, part_size, total_parts FROM uploads WHERE fingerprint = ?"
+	SELECT_UPLOAD_PARTS = "SELECT part FROM upload_parts WHERE fingerprint = ?"
+	INSERT_UPLOAD = "INSERT OR REPLACE INTO uploads values(?, ?, ?, ?)"
+	INSERT_UPLOAD_PART = "INSERT OR IGNORE INTO upload_parts values(?, ?)"
+	REMOVE_UPLOAD = "DELETE FROM uploads WHERE fingerprint = ?"
+	REMOVE_UPLOAD_PARTS = "DELETE FROM upload_parts WHERE fingerprint = ?"
+	#A file already queued is left as it is - The sent files are recorded by the managed files, not by the jobs
+	DISCOVER_JOB = ("INSERT INTO upload_jobs(file_name, path, state, attempts, next_attempt_at, discovered_at, updated_at) "
+		"VALUES(?, ?, 'discovered', 0, 0, ?, ?) ON CONFLICT(file_name) DO NOTHING")
+	SELECT_JOBS = "SELECT file_name, path, discovered_at FROM upload_jobs WHERE state = ? ORDER BY rowid LIMIT ?"
+	MARK_JOB_STABLE = "UPDATE upload_jobs SET state = 'stable', next_attempt_at = ?, updated_at = ? WHERE file_name = ? AND state = 'discovered'"
+	SELECT_CLAIMABLE_JOBS = ("SELECT file_name, path, attempts FROM upload_jobs WHERE (state = 'stable' AND next_attempt_at <= ?) "
+		"OR (state = 'uploading' AND lease_until < ?) ORDER BY next_attempt_at LIMIT ?")
+	CLAIM_JOB = "UPDATE upload_jobs SET state = 'uploading', owner = ?, lease_until = ?, attempts = ?, updated_at = ? WHERE file_name = ?"
+	RENEW_LEASES = "UPDATE upload_jobs SET lease_until = ? WHERE owner = ? AND state = 'uploading'"
+	COMPLETE_JOB = "DELETE FROM upload_jobs WHERE file_name = ? AND owner = ?"
+	#Jobs completed before they were deleted on completion
+	PRUNE_SENT_JOBS = "DELETE FROM upload_jobs WHERE state = 'sent'"
+	RETRY_JOB = ("UPDATE upload_jobs SET state = 'stable', owner = NULL, lease_until = NULL, next_attempt_at = ?, last_error = ?, "
+		"updated_at = ? WHERE file_name = ? AND owner = ?")
+	#An interrupted attempt is given back, since the upload did not fail
+	RELEASE_JOB = ("UPDATE upload_jobs SET state = 'stable', owner = NULL, lease_until = NULL, attempts = MAX(attempts - 1, 0), "
+		"next_attempt_at = ?, updated_at = ? WHERE file_name = ? AND owner = ?")
+	FAIL_JOB = ("UPDATE upload_jobs SET state = 'failed', owner = NULL, lease_until = NULL, last_error = ?, updated_at = ? "
+		"WHERE file_name = ? AND COALESCE(owner, '') = ?")
+	REMOVE_JOB = "DELETE FROM upload_jobs WHERE file_name = ? AND COALESCE(owner, '') = ?"
+	COUNT_JOBS = "SELECT state, COUNT(*) FROM upload_jobs GROUP BY state"
+	NEXT_JOB_DUE = ("SELECT MIN(CASE WHEN state = 'stable' THEN next_attempt_at ELSE lease_until END) FROM upload_jobs "
+		"WHERE state = 'stable' OR (state = 'uploading' AND owner != ?)")
+	SELECT_FAILED_JOBS = "SELECT file_name, attempts, last_error FROM upload_jobs WHERE state = 'failed' ORDER BY updated_at DESC LIMIT ?"
+	RETRY_FAILED_JOBS = ("UPDATE upload_jobs SET state = 'discovered', attempts = 0, last_error = NULL, discovered_at = ?, updated_at = ? "
+		"WHERE state = 'failed'")
+
+	#The states of an upload job
+	JOB_DISCOVERED = "discovered"
+	JOB_STABLE = "stable"
+	JOB_UPLOADING = "uploading"
+	JOB_FAILED = "failed"
+	JOB_STATES = (JOB_DISCOVERED, JOB_STABLE, JOB_UPLOADING, JOB_FAILED)
+
+	#Rows fetched for each step while streaming the file list
+	FETCH_SIZE = 1000
+
 	#Load config and psw
 	def __init__(self, dbPath, loggingHandler):
 		self.dbName = dbPath
 		self.logging = loggingHandler
-				
+		#The connection is shared by watcher, scheduler and bot threads - Every access is serialized by the lock
+		self.lock = threading.RLock()
+		self.conn = None
+
 		#Initialize db if missing
-		if not self.dbExists():
-			self.createTables()
+		existing = self.dbExists()
+		self.connect()
+		self.createTables()
+		if not existing:
 			self.logging.info("All tables created")
-	
+
 	def dbExists(self):
 		return os.path.isfile(self.dbName)
 
+	#Open the long-lived connection
+	def connect(self):
+		with self.lock:
+			if self.conn is None:
+				self.conn = sqlite3.connect(self.dbName, check_same_thread=False, cached_statements=64)
+				self.conn.execute("PRAGMA journal_mode=WAL")
+				self.conn.execute("PRAGMA synchronous=NORMAL")
+				self.logging.info("Db connected")
+			return self.conn
+
+	#Close the connection
+	def close(self):
+		with self.lock:
+			if self.conn is not None:
+				self.conn.close()
+				self.conn = None
+				self.logging.info("Db disconnected")
+
 	#Create all tables
 	def createTables(self):
-		#Start connection
-		conn = sqlite3.connect(self.dbName)
-		cursor = conn.cursor()
-		self.logging.info("Db connected")
-		#Create here tables
-		self.createFileListTable(cursor)
-		#Close connection
-		conn.commit()
-		conn.close()
-		
+		with self.lock, self.conn:
+			cursor = self.conn.cursor()
+			#Create here tables
+			self.createFileListTable(cursor)
+			self.createFileIdTable(cursor)
+			self.createUploadTables(cursor)
+			self.createUploadJobTable(cursor)
+
 	#Create the table to store the chat
 	def createFileListTable(self, cursor):
-		sql = "CREATE TABLE files(file_name varchar(64), UNIQUE(file_name))"
+		sql = "CREATE TABLE IF NOT EXISTS files(file_name varchar(64), UNIQUE(file_name))"
 		cursor.execute(sql)
 
+	#Create the table to remember the Telegram reference of the uploaded contents
+	def createFileIdTable(self, cursor):
+		sql = "CREATE TABLE IF NOT EXISTS file_ids(fingerprint varchar(64), kind varchar(16), file_id text, UNIQUE(fingerprint, kind))"
+		cursor.execute(sql)
+
+	#Create the tables to track the progress of the big uploads
+	def createUploadTables(self, cursor):
+		sql = "CREATE TABLE IF NOT EXISTS uploads(fingerprint varchar(64), file_id integer, part_size integer, total_parts integer, UNIQUE(fingerprint))"
+		cursor.execute(sql)
+		sql = "CREATE TABLE IF NOT EXISTS upload_parts(fingerprint varchar(64), part integer, UNIQUE(fingerprint, part))"
+		cursor.execute(sql)
+
+	#Create the persistent queue of the files to upload
+	def createUploadJobTable(self, cursor):
+		sql = ("CREATE TABLE IF NOT EXISTS upload_jobs(file_name text, path text, state varchar(16), attempts integer, "
+			"next_attempt_at real, owner varchar(32), lease_until real, discovered_at real, updated_at real, last_error text, UNIQUE(file_name))")
+		cursor.execute(sql)
+		sql = "CREATE INDEX IF NOT EXISTS upload_jobs_state ON upload_jobs(state, next_attempt_at)"
+		cursor.execute(sql)
+		cursor.execute(self.PRUNE_SENT_JOBS)
+
 	#Add an element
 	def insertFile(self, filename):
-		#Start connection
-		conn = sqlite3.connect(self.dbName)
-		cursor = conn.cursor()
-		self.logging.info("Db connected")
-		sql = "INSERT OR IGNORE INTO files values(?)"
-		if type(filename) is not list:
-			filename = [str(filename)]
-		cursor.executemany(sql, [filename])
-		#Close connection
-		conn.commit()
-		conn.close()
+		if type(filename) is list:
+			return self.insertFiles(filename)
+		return self.insertFiles([filename])
+
+	#Add many elements in a single transaction
+	def insertFiles(self, filenames):
+		with DB_SECONDS.labels("insert_files").time(), self.lock, self.conn:
+			self.conn.executemany(self.INSERT_FILE, [(str(f),) for f in filenames])
 
 	#Delete an element
 	def removeFile(self, filename):
-		#Start connection
-		conn = sqlite3.connect(self.dbName)
-		cursor = conn.cursor()
-		self.logging.info("Db connected")
-		#Execute
-		sql = "DELETE FROM files where file_name = ?"
-		if type(filename) is not list:
-			filename = [str(filename)]
-		cursor.executemany(sql, [filename])
-		#Close connection
-		conn.commit()
-		conn.close()
+		if type(filename) is list:
+			return self.removeFiles(filename)
+		return self.removeFiles([filename])
+
+	#Delete many elements in a single transaction
+	def removeFiles(self, filenames):
+		with DB_SECONDS.labels("remove_files").time(), self.lock, self.conn:
+			self.conn.executemany(self.REMOVE_FILE, [(str(f),) for f in filenames])
+
+	#Stream all the files without building the full list
+	def iterFiles(self):
+		last_rowid = 0
+		while True:
+			with DB_SECONDS.labels("iter_files").time(), self.lock:
+				rows = self.conn.execute(self.SELECT_FILES, (last_rowid, self.FETCH_SIZE)).fetchall()
+			if not rows:
+				return
+			for rowid, file_name in rows:
+				yield file_name
+			last_rowid = rows[-1][0]
 
 	#Retrieve all the users
 	def getFiles(self):
-		#Start connection
-		conn = sqlite3.connect(self.dbName)
-		cursor = conn.cursor()
-		self.logging.info("Db connected")
-		#Execute
-		sql = "SELECT * FROM files"
-		res = cursor.execute(sql)
-		#Create list from query
-		c_list = []
-		for row in res:
-			c_list.append(row[0])
-		#Close connection
-		conn.commit()
-		conn.close()
-		return c_list
+		return list(self.iterFiles())
+
+	#Retrieve the Telegram reference of an uploaded content
+	def getFileId(self, fingerprint, kind):
+		with DB_SECONDS.labels("get_file_id").time(), self.lock:
+			row = self.conn.execute(self.SELECT_FILE_ID, (fingerprint, kind)).fetchone()
+		return row[0] if row else None
+
+	#Remember the Telegram reference of an uploaded content
+	def storeFileId(self, fingerprint, kind, file_id):
+		with DB_SECONDS.labels("store_file_id").time(), self.lock, self.conn:
+			self.conn.execute(self.INSERT_FILE_ID, (fingerprint, kind, str(file_id)))
+
+	#Forget an expired Telegram reference
+	def removeFileId(self, fingerprint, kind):
+		with DB_SECONDS.labels("remove_file_id").time(), self.lock, self.conn:
+			self.conn.execute(self.REMOVE_FILE_ID, (fingerprint, kind))
+
+	#Retrieve the progress of an upload - Returns (file id, part size, total parts, acknowledged parts) or None
+	def getUpload(self, fingerprint):
+		with DB_SECONDS.labels("get_upload").time(), self.lock:
+			row = self.conn.execute(self.SELECT_UPLOAD, (fingerprint,)).fetchone()
+			if not row:
+				return None
+			parts = {r[0] for r in self.conn.execute(self.SELECT_UPLOAD_PARTS, (fingerprint,))}
+		return row[0], row[1], row[2], parts
+
+	#Start tracking a new upload, forgetting any previous progress
+	def startUpload(self, fingerprint, file_id, part_size, total_parts):
+		with DB_SECONDS.labels("start_upload").time(), self.lock, self.conn:
+			self.conn.execute(self.REMOVE_UPLOAD_PARTS, (fingerprint,))
+			self.conn.execute(self.INSERT_UPLOAD, (fingerprint, file_id, part_size, total_parts))
+
+	#Record the parts acknowledged by Telegram, in a single transaction
+	def storeUploadParts(self, fingerprint, parts):
+		with DB_SECONDS.labels("store_upload_parts").time(), self.lock, self.conn:
+			self.conn.executemany(self.INSERT_UPLOAD_PART, [(fingerprint, part) for part in parts])
+
+	#Forget a completed upload
+	def removeUpload(self, fingerprint):
+		with DB_SECONDS.labels("remove_upload").time(), self.lock, self.conn:
+			self.conn.execute(self.REMOVE_UPLOAD_PARTS, (fingerprint,))
+			self.conn.execute(self.REMOVE_UPLOAD, (fingerprint,))
+
+	#Queue new files to upload - Returns the number of files queued
+	def discoverJobs(self, files, now):
+		with DB_SECONDS.labels("discover_jobs").time(), self.lock, self.conn:
+			before = self.conn.total_changes
+			self.conn.executemany(self.DISCOVER_JOB, [(str(name), str(path), now, now) for name, path in files])
+			return self.conn.total_changes - before
+
+	#Retrieve the jobs in a state - Returns a list of (file name, path, discovery time)
+	def getJobs(self, state, limit=FETCH_SIZE):
+		with DB_SECONDS.labels("get_jobs").time(), self.lock:
+			return self.conn.execute(self.SELECT_JOBS, (state, limit)).fetchall()
+
+	#Mark the discovered files as ready to upload
+	def markJobsStable(self, filenames, now):
+		with DB_SECONDS.labels("mark_jobs_stable").time(), self.lock, self.conn:
+			self.conn.executemany(self.MARK_JOB_STABLE, [(now, now, str(f)) for f in filenames])
+
+	#Lease the jobs ready to upload, and those whose lease expired - Returns a list of (file name, path, attempt)
+	def claimJobs(self, owner, now, leaseUntil, limit):
+		with DB_SECONDS.labels("claim_jobs").time(), self.lock, self.conn:
+			rows = self.conn.execute(self.SELECT_CLAIMABLE_JOBS, (now, now, limit)).fetchall()
+			jobs = [(file_name, path, attempts + 1) for file_name, path, attempts in rows]
+			self.conn.executemany(self.CLAIM_JOB, [(owner, leaseUntil, attempt, now, file_name) for file_name, path, attempt in jobs])
+		return jobs
+
+	#Extend the leases of all the jobs held by an owner
+	def renewLeases(self, owner, leaseUntil):
+		with DB_SECONDS.labels("renew_leases").time(), self.lock, self.conn:
+			self.conn.execute(self.RENEW_LEASES, (leaseUntil, owner))
+
+	#Forget a leased job once its file is sent - The delivery is recorded by the managed files
+	def completeJob(self, filename, owner):
+		with DB_SECONDS.labels("complete_job").time(), self.lock, self.conn:
+			self.conn.execute(self.COMPLETE_JOB, (str(filename), owner))
+
+	#Release a leased job, to be attempted again later
+	def retryJob(self, filename, owner, nextAttemptAt, error, now):
+		with DB_SECONDS.labels("retry_job").time(), self.lock, self.conn:
+			self.conn.execute(self.RETRY_JOB, (nextAttemptAt, str(error), now, str(filename), owner))
+
+	#Release a leased job whose upload was interrupted, without counting the attempt
+	def releaseJob(self, filename, owner, now):
+		with DB_SECONDS.labels("release_job").time(), self.lock, self.conn:
+			self.conn.execute(self.RELEASE_JOB, (now, now, str(filename), owner))
+
+	#Give up a job - Leased jobs are matched by owner, the others by an empty owner
+	def failJob(self, filename, error, now, owner=""):
+		with DB_SECONDS.labels("fail_job").time(), self.lock, self.conn:
+			self.conn.execute(self.FAIL_JOB, (str(error), now, str(filename), owner))
+
+	#Forget a job - Leased jobs are matched by owner, the others by an empty owner
+	def removeJob(self, filename, owner=""):
+		with DB_SECONDS.labels("remove_job").time(), self.lock, self.conn:
+			self.conn.execute(self.REMOVE_JOB, (str(filename), owner))
+
+	#Count the jobs in each state
+	def countJobs(self):
+		with DB_SECONDS.labels("count_jobs").time(), self.lock:
+			return dict(self.conn.execute(self.COUNT_JOBS).fetchall())
+
+	#The time of the next job that can be claimed, ignoring those leased by the given owner - None if there are none
+	def nextJobDue(self, owner):
+		with DB_SECONDS.labels("next_job_due").time(), self.lock:
+			return self.conn.execute(self.NEXT_JOB_DUE, (owner,)).fetchone()[0]
+
+	#Retrieve the last failed jobs - Returns a list of (file name, attempts, last error)
+	def getFailedJobs(self, limit):
+		with DB_SECONDS.labels("get_failed_jobs").time(), self.lock:
+			return self.conn.execute(self.SELECT_FAILED_JOBS, (limit,)).fetchall()
+
+	#Queue the failed jobs again - Returns the number of jobs queued
+	def retryFailedJobs(self, now):
+		with DB_SECONDS.labels("retry_failed_jobs").time(), self.lock, self.conn:
+			return self.conn.execute(self.RETRY_FAILED_JOBS, (now, now)).rowcount
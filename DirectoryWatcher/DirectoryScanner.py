@@ -0,0 +1,116 @@
+import os
+import time
+
+from Metrics import REGISTRY
+
+SCAN_SECONDS = REGISTRY.histogram("giornalettiere_scan_seconds", "Time spent scanning the download directory")
+SCAN_LISTED = REGISTRY.counter("giornalettiere_scan_listed_directories_total", "Directories listed again because they changed")
+SCAN_NEW_FILES = REGISTRY.counter("giornalettiere_scan_new_files_total", "Files found by the scans")
+SCAN_DIRECTORIES = REGISTRY.gauge("giornalettiere_scan_directories", "Directories visited by the last scan")
+
+
+class DirectoryState:
+	"""
+	The last known content of a single directory
+	"""
+
+	__slots__ = ("mtime", "files", "dirs", "trusted")
+
+	def __init__(self, mtime, files, dirs, trusted):
+		self.mtime = mtime
+		self.files = files
+		self.dirs = dirs
+		self.trusted = trusted
+
+
+class DirectoryScanner:
+	"""
+	Incrementally scans a directory tree.
+	Keeps a snapshot with the mtime and the entries of every directory, so that each scan costs one stat
+	per directory and only the directories that changed since the previous scan are listed again
+	"""
+
+	MTIME_GRANULARITY = 2 * 10 ** 9
+	"""
+	Directories modified this close (in ns) to the scan are listed again on the next scan,
+	since a later change could leave their mtime untouched on coarse-grained filesystems (e.g. SMB, NFS)
+	"""
+
+	def __init__(self, root, logging=None):
+		self.root = root
+		self.logging = logging
+		self.snapshot = {}
+
+	def reset(self):
+		"""
+		Forget the snapshot, the next scan will report every file again
+		:return: None
+		"""
+		self.snapshot = {}
+
+	def scan(self):
+		"""
+		Scan the tree looking for files added since the previous scan
+		:return: The list of (directory, file name) added since the previous scan (every file on the first scan)
+		"""
+		new_files = []
+		visited = set()
+		listed = 0
+		started = time.perf_counter()
+		scan_start = time.time_ns()
+		stack = [self.root]
+		while stack:
+			directory = stack.pop()
+			try:
+				mtime = os.stat(directory).st_mtime_ns
+			except OSError:
+				continue
+			visited.add(directory)
+			state = self.snapshot.get(directory)
+			if state is None or not state.trusted or state.mtime != mtime:
+				previous_files = state.files if state else frozenset()
+				state = self.list_directory(directory, mtime, scan_start)
+				if state is None:
+					continue
+				self.snapshot[directory] = state
+				listed += 1
+				new_files.extend((directory, f) for f in state.files if f not in previous_files)
+			stack.extend(os.path.join(directory, d) for d in state.dirs)
+		# Drop the directories removed since the previous scan
+		for directory in self.snapshot.keys() - visited:
+			del self.snapshot[directory]
+		SCAN_SECONDS.observe(time.perf_counter() - started)
+		SCAN_LISTED.inc(listed)
+		SCAN_NEW_FILES.inc(len(new_files))
+		SCAN_DIRECTORIES.set(len(visited))
+		if self.logging:
+			self.logging.info(f"DirectoryScanner - Visited {len(visited)} directories, listed {listed}, found {len(new_files)} new files")
+		return new_files
+
+	def list_directory(self, directory, mtime, scan_start):
+		"""
+		List the content of a directory
+		:param directory: The directory to list
+		:param mtime: The directory mtime (in ns) observed before listing it
+		:param scan_start: The scan start time (in ns)
+		:return: The new state of the directory, None if it cannot be listed
+		"""
+		files = set()
+		dirs = []
+		try:
+			with os.scandir(directory) as entries:
+				for entry in entries:
+					try:
+						is_dir = entry.is_dir()
+					except OSError:
+						is_dir = False
+					if not is_dir:
+						files.add(entry.name)
+					elif not entry.is_symlink():
+						dirs.append(entry.name)
+		except OSError as err:
+			if self.logging:
+				self.logging.warning(f"DirectoryScanner - Cannot list [{directory}] [{err}]")
+			return None
+		trusted = mtime < scan_start - self.MTIME_GRANULARITY
+		return DirectoryState(mtime, frozenset(files), dirs, trusted)
@@ -1,16 +1,45 @@
+import concurrent.futures
 import threading
 import inotify.adapters
 import os
 import time
 
+from Metrics import REGISTRY
+
+WATCHER_EVENTS = REGISTRY.counter("giornalettiere_watcher_events_total", "Directory events registered by the watchers", ["event"])
+WATCHER_DISPATCHES = REGISTRY.counter("giornalettiere_watcher_dispatches_total", "Bursts of events dispatched by the watchers")
+WATCHER_DISPATCHED_FILES = REGISTRY.histogram("giornalettiere_watcher_dispatched_files", "Files in each dispatched burst",
+	buckets=(1, 2, 5, 10, 25, 50, 100, 250, 1000))
+WATCHER_DEFERRED = REGISTRY.counter("giornalettiere_watcher_deferred_total", "Dispatches delayed until the previous update ended")
+
 
 class DirectoryWatcher(threading.Thread):
 
-	def __init__(self, callback_function: callable, logging=None):
+	CLOSING_EVENTS = ('IN_CLOSE_WRITE', 'IN_MOVED_TO')
+	"""
+	Events meaning that the file has been completely written
+	"""
+
+	def __init__(self, callback_function: callable, logging=None, stability_tracker=None, debounce=1.0):
+		"""
+		Create the watcher
+		:param callback_function: Called with the list of files of a burst of events.
+				If it returns a concurrent Future, no other call is made until it is done and the events are merged meanwhile
+		:param logging: A logging instance
+		:param stability_tracker: The StabilityTracker notified of the files closed after writing
+		:param debounce: Seconds without events after which a burst is dispatched
+		"""
 		threading.Thread.__init__(self)
 		self.watched_events = None
 		self.logging = logging
 		self.callbackFunction = callback_function
+		self.stabilityTracker = stability_tracker
+		self.debounce = debounce
+		self.maxDelay = debounce * 10
+		self.pending = {}
+		self.firstEvent = None
+		self.lastEvent = None
+		self.inFlight = None
 		self.logging.info("Created DirectoryWatcher element")
 
 	def watch_this_directory(self, directory, events, recursively=False):
@@ -31,11 +60,13 @@ class DirectoryWatcher(threading.Thread):
 			self.logging.info("No events to monitor")
 			raise Exception('No events to monitor')
 
+		# Wake up often enough to dispatch a burst once the debounce window expires
+		block_duration = min(1.0, max(0.1, self.debounce / 2))
 		if recursively:
-			self.notifier = inotify.adapters.InotifyTree(directory)
+			self.notifier = inotify.adapters.InotifyTree(directory, block_duration_s=block_duration)
 			self.logging.info("Starting a recursive monitoring on directory and subdirectory [" + directory + "]")
 		else:
-			self.notifier = inotify.adapters.Inotify()
+			self.notifier = inotify.adapters.Inotify(block_duration_s=block_duration)
 			self.notifier.add_watch(directory)
 			self.logging.info("Starting a plain monitoring on directory [" + directory + "]")
 
@@ -46,27 +77,61 @@ class DirectoryWatcher(threading.Thread):
 					if event is not None:
 						for we in self.watched_events:
 							if we in event[1]:
+								WATCHER_EVENTS.labels(we).inc()
 								new_file = os.path.join(event[2], event[3])
-								self.logging.info(f"Registered event [{event[1]}] for file [{new_file}]")
-								try:
-									while not self.stable_size(new_file):
-										self.logging.info(f"Still writing on file [{new_file}]")
-									self.callbackFunction(new_file)
-								except FileNotFoundError as err:
-									self.logging.warning(f"File missing [{new_file}] - Skipping callback [{err}]")
+								self.logging.debug(f"Registered event [{event[1]}] for file [{new_file}]")
+								if self.stabilityTracker and we in self.CLOSING_EVENTS:
+									self.stabilityTracker.mark_closed(new_file)
+								self.register(new_file)
+								break
+					self.dispatch()
 				self.logging.warning("DirectoryWatcher stopped checking directory")
 			except RuntimeError as err:
 				self.logging.exception(f"Thread is dead for a Runtime error [{err}]")
 			except Exception as err:
 				self.logging.exception(f"Unexpected thread death [{err}]")
 
-	@staticmethod
-	def stable_size(my_file):
+	def register(self, new_file):
+		"""
+		Add a file to the current burst of events
+		:param new_file: The file that generated the event
+		:return: None
+		"""
+		now = time.monotonic()
+		if not self.pending:
+			self.firstEvent = now
+		self.lastEvent = now
+		self.pending[new_file] = None
+
+	def dispatch(self):
+		"""
+		Invoke the callback with the current burst once it is over (or too old) and the previous call is done
+		:return: None
+		"""
+		if not self.pending:
+			return
+		now = time.monotonic()
+		if now - self.lastEvent < self.debounce and now - self.firstEvent < self.maxDelay:
+			return
+		if self.inFlight is not None and not self.inFlight.done():
+			# Back-pressure - Keep merging events until the running update ends
+			WATCHER_DEFERRED.inc()
+			return
+		files = list(self.pending)
+		self.pending = {}
+		self.logging.info(f"DirectoryWatcher - Dispatching {len(files)} changed files")
+		WATCHER_DISPATCHES.inc()
+		WATCHER_DISPATCHED_FILES.observe(len(files))
+		result = self.callbackFunction(files)
+		if isinstance(result, concurrent.futures.Future):
+			self.inFlight = result
+			result.add_done_callback(self.log_failure)
+
+	def log_failure(self, future):
 		"""
-		Check if the file is still being written
-		:param my_file: The file to control
-		:return: True if the file has not changed size during last second. False otherwise
+		Log the failure of a dispatched callback
+		:param future: The completed future
+		:return: None
 		"""
-		initial_size = os.path.getsize(my_file)
-		time.sleep(1)
-		return os.path.getsize(my_file) == initial_size
+		if not future.cancelled() and future.exception():
+			self.logging.error(f"DirectoryWatcher - Update failed [{future.exception()}]")
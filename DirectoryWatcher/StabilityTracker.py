@@ -0,0 +1,83 @@
+import os
+import threading
+
+
+class StabilityTracker:
+	"""
+	Tracks the files that are still being written.
+	All the pending files are sampled together once per settle interval, so a batch of files settles in about
+	one interval regardless of its size. Files reported as closed after writing (IN_CLOSE_WRITE) settle immediately
+	"""
+
+	MAX_CLOSED = 1024
+	"""
+	Maximum number of close notifications remembered for files not tracked yet
+	"""
+
+	def __init__(self, settle_interval=1.0, logging=None):
+		self.settleInterval = settle_interval
+		self.logging = logging
+		self.lock = threading.Lock()
+		self.samples = {}
+		self.closed = {}
+
+	@staticmethod
+	def sample(my_file):
+		"""
+		Sample the current state of a file
+		:param my_file: The file to sample
+		:return: The tuple (size, mtime) of the file
+		"""
+		stat = os.stat(my_file)
+		return stat.st_size, stat.st_mtime_ns
+
+	def mark_closed(self, my_file):
+		"""
+		Notify that a file has been closed after writing - Called by the DirectoryWatcher thread
+		:param my_file: The closed file
+		:return: None
+		"""
+		try:
+			sample = self.sample(my_file)
+		except OSError:
+			return
+		with self.lock:
+			if len(self.closed) >= self.MAX_CLOSED:
+				self.closed.pop(next(iter(self.closed)))
+			self.closed[my_file] = sample
+
+	def forget(self, files):
+		"""
+		Stop tracking files no longer waited for (e.g. given up because they never stopped changing)
+		:param files: The files to forget
+		:return: None
+		"""
+		with self.lock:
+			for my_file in files:
+				self.samples.pop(my_file, None)
+				self.closed.pop(my_file, None)
+
+	def poll(self, files):
+		"""
+		Sample all the given files at once
+		:param files: The files waiting to become stable
+		:return: The tuple (stable files, missing files)
+		"""
+		stable = []
+		missing = []
+		with self.lock:
+			for my_file in files:
+				try:
+					sample = self.sample(my_file)
+				except OSError:
+					missing.append(my_file)
+					self.samples.pop(my_file, None)
+					self.closed.pop(my_file, None)
+					continue
+				if self.closed.get(my_file) == sample or self.samples.get(my_file) == sample:
+					stable.append(my_file)
+					self.samples.pop(my_file, None)
+					self.closed.pop(my_file, None)
+				else:
+					self.samples[my_file] = sample
+		return stable, missing
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+import os
+import threading
+import tomllib
+
+from DirectoryWatcher.DirectoryWatcher import DirectoryWatcher
+from GiornalettiereDownloader import GiornalettiereDownloader
+
+# The directory events meaning that a download configuration changed
+CONFIG_EVENTS = ['IN_CLOSE_WRITE', 'IN_MOVED_TO', 'IN_MOVED_FROM', 'IN_DELETE']
+
+
+class DownloadConfigRegistry:
+    """
+    Keeps a GiornalettiereDownloader for each download configuration, built once and reused across searches
+    so that their HTTP sessions and compiled state stay warm.
+    Only the configuration files changed since the last search are loaded again
+    """
+
+    def __init__(self, config_dir, logging_handler, cache_dir=None):
+        """
+        Create the registry
+        :param config_dir: The directory containing the *.toml download configurations
+        :param logging_handler: A logging instance
+        :param cache_dir: The directory used by the downloaders to cache the pages
+        """
+        self.configDir = config_dir
+        self.logging = logging_handler
+        self.cacheDir = cache_dir
+        self.lock = threading.Lock()
+        self.downloaders = {}
+        self.invalid = {}
+        self.dirty = True
+        self.watcher = None
+
+    def watch(self):
+        """
+        Watch the configuration directory, so that it is checked again only after a change
+        :return: None
+        """
+        try:
+            self.watcher = DirectoryWatcher(self.mark_dirty, self.logging)
+            self.watcher.watch_this_directory(self.configDir, CONFIG_EVENTS)
+            self.watcher.daemon = True
+            self.watcher.start()
+            self.logging.info("DownloadConfigRegistry - Watching [" + self.configDir + "]")
+        except Exception as err:
+            self.watcher = None
+            self.logging.warning(f"DownloadConfigRegistry - Cannot watch [{self.configDir}] - Checking it on every search [{err}]")
+
+    def mark_dirty(self, files=None):
+        """
+        Notify that the configurations changed - Called by the watcher thread
+        :param files: The changed files
+        :return: None
+        """
+        self.dirty = True
+
+    def get_downloaders(self):
+        """
+        Return the downloaders of all the configurations, reloading the changed ones
+        :return: The list of (configuration file name, GiornalettiereDownloader)
+        """
+        with self.lock:
+            if self.dirty or self.watcher is None or not self.watcher.is_alive():
+                self.dirty = False
+                self.reload()
+            return [(filename, self.downloaders[filename][1]) for filename in sorted(self.downloaders)]
+
+    def reload(self):
+        """
+        Load the new and changed configurations, forgetting the removed ones
+        :return: None
+        """
+        try:
+            filenames = [f for f in os.listdir(self.configDir) if f.endswith(".toml")]
+        except OSError as err:
+            self.logging.error(f"DownloadConfigRegistry - Cannot list [{self.configDir}] [{err}]")
+            filenames = []
+        current = {}
+        for filename in filenames:
+            path = os.path.join(self.configDir, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            version = (stat.st_mtime_ns, stat.st_size)
+            previous = self.downloaders.get(filename)
+            if previous and previous[0] == version:
+                current[filename] = previous
+                continue
+            if self.invalid.get(filename) == version:
+                continue
+            try:
+                with open(path, "rb") as f:
+                    downloadConfig = tomllib.load(f)
+                current[filename] = (version, GiornalettiereDownloader(self.logging, downloadConfig, self.cacheDir))
+                self.logging.info(f"DownloadConfigRegistry - Loaded [{filename}]")
+            except (OSError, tomllib.TOMLDecodeError, KeyError, TypeError, ValueError) as err:
+                self.invalid[filename] = version
+                self.logging.error(f"DownloadConfigRegistry - Invalid configuration [{filename}] - Skipped [{err}]")
+        # The replaced and removed downloaders are not closed, since a search may still be using them:
+        # their connections are released once the last search holding them ends
+        for filename in self.downloaders:
+            if filename not in current:
+                self.logging.info(f"DownloadConfigRegistry - Removed [{filename}]")
+        self.downloaders = current
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+import asyncio
+import time
+
+import requests
+
+
+class DownloadSubmitter:
+    """
+    Sends the links to download to the download site without blocking the caller.
+    Links submitted within a short window are merged into a single request, failed requests are retried
+    with exponential backoff and links already submitted recently are ignored
+    """
+
+    def __init__(self, site, title, logging_handler, window=2.0, retries=5, dedup_seconds=43200, timeout=(5, 30)):
+        """
+        Create the submitter
+        :param site: The download site URL
+        :param title: The title sent with every request
+        :param logging_handler: A logging instance
+        :param window: Seconds waited to merge the links submitted together
+        :param retries: Attempts made for each request
+        :param dedup_seconds: Seconds during which an already submitted link is ignored
+        :param timeout: The (connect, read) timeout in seconds of each request
+        """
+        self.site = site
+        self.title = title
+        self.logging = logging_handler
+        self.window = window
+        self.retries = max(1, int(retries))
+        self.dedupSeconds = dedup_seconds
+        self.timeout = tuple(timeout) if isinstance(timeout, (list, tuple)) else timeout
+        self.session = requests.Session()
+        self.loop = None
+        self.pending = {}
+        self.recent = {}
+        self.flushTask = None
+        self.tasks = set()
+
+    def start(self, loop):
+        """
+        Attach the submitter to the running event loop
+        :param loop: The event loop that sends the requests
+        :return: None
+        """
+        self.loop = loop
+
+    async def stop(self):
+        """
+        Send the links still waiting as a single request, without waiting for the window nor retrying
+        - Called on the event loop before it is closed
+        :return: None
+        """
+        tasks, self.tasks = set(self.tasks), set()
+        for task in tasks:
+            task.cancel()
+        # The cancelled requests put their links back among the pending ones
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.flushTask = None
+        self.loop = None
+        links = list(self.pending)
+        self.pending = {}
+        if links:
+            try:
+                await asyncio.to_thread(self.send, links)
+            except requests.exceptions.RequestException as err:
+                self.logging.error(f"DownloadSubmitter - Cannot request {len(links)} links on stop [{', '.join(links)}] [{err}]")
+        self.logging.info("DownloadSubmitter - Stopped")
+
+    def submit(self, links):
+        """
+        Queue links for download - Returns immediately and can be called from any thread
+        :param links: The list of links to download
+        :return: None
+        """
+        if self.loop is None or self.loop.is_closed():
+            self.logging.warning("DownloadSubmitter - Event loop not running - Sending the request now")
+            try:
+                self.send(list(links))
+            except requests.exceptions.RequestException as err:
+                self.logging.error(f"DownloadSubmitter - Request failed [{err}]")
+            return
+        self.loop.call_soon_threadsafe(self.enqueue, list(links))
+
+    def enqueue(self, links):
+        """
+        Add the links to the next request - Runs on the event loop
+        :param links: The list of links to download
+        :return: None
+        """
+        now = time.monotonic()
+        self.recent = {link: at for link, at in self.recent.items() if now - at < self.dedupSeconds}
+        for link in links:
+            if link in self.recent or link in self.pending:
+                self.logging.info(f"DownloadSubmitter - Link already requested [{link}] - Skipped")
+                continue
+            self.pending[link] = now
+        if self.pending and self.flushTask is None:
+            self.flushTask = self.loop.create_task(self.flush())
+            self.tasks.add(self.flushTask)
+            self.flushTask.add_done_callback(self.tasks.discard)
+
+    async def flush(self):
+        """
+        Send the links collected during the window as a single request
+        :return: None
+        """
+        # Cancelled during the window (by stop), the links stay pending
+        await asyncio.sleep(self.window)
+        links = list(self.pending)
+        self.pending = {}
+        self.flushTask = None
+        # Links being sent are not requested again meanwhile
+        now = time.monotonic()
+        for link in links:
+            self.recent[link] = now
+        try:
+            for attempt in range(1, self.retries + 1):
+                request = asyncio.ensure_future(asyncio.to_thread(self.send, links))
+                try:
+                    # Shielded, so that a request already started is never sent again by stop
+                    await asyncio.shield(request)
+                    return
+                except requests.exceptions.RequestException as err:
+                    if attempt == self.retries:
+                        break
+                    delay = 2 ** attempt
+                    self.logging.warning(f"DownloadSubmitter - Request failed [{err}] - Retry {attempt}/{self.retries} in {delay}s")
+                    await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            # Stopped while sending or waiting to retry - The links not delivered are sent once more by stop
+            await asyncio.wait([request])
+            if request.cancelled() or request.exception() is not None:
+                for link in links:
+                    self.pending.setdefault(link, now)
+            raise
+        self.logging.error(f"DownloadSubmitter - Cannot request {len(links)} links [{', '.join(links)}]")
+        for link in links:
+            self.recent.pop(link, None)
+
+    def send(self, links):
+        """
+        Send a request to the download site
+        :param links: The list of links to download
+        :return: None
+        """
+        payload = {'titolo': self.title, 'link': "\n".join(links)}
+        self.logging.info("DownloadSubmitter - Request download to my site [" + self.site + "]")
+        response = self.session.post(self.site, data=payload, timeout=self.timeout)
+        response.raise_for_status()
+        self.logging.info(
+            "DownloadSubmitter - Request download of " + str(len(links)) + " files [" + ", ".join(links) + "]")
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+import codecs
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml  # noqa: F401 - Only checks that the faster parser is available
+    HTML_PARSER = 'lxml'
+except ImportError:
+    HTML_PARSER = 'html.parser'
+
+
+def compile_step(search_step):
+    """
+    Translate a search step of the configuration into the arguments of BeautifulSoup.find
+    :param search_step: The search step (e.g. {attribute = "class", name = "news", type = "a"})
+    :return: The tuple (tag name, attributes)
+    """
+    attr = {}
+    attribute = search_step.get('attribute', None)
+    name = search_step.get('name', None)
+    if attribute in ("class", "id") and name:
+        attr[attribute] = name
+    return search_step.get('type', None), attr
+
+
+def run_steps(soup, steps):
+    """
+    Execute compiled search steps
+    :param soup: The element where the search starts
+    :param steps: The compiled steps
+    :return: The element reached, None if a step finds nothing
+    """
+    for html_type, attributes in steps:
+        soup = soup.find(name=html_type, attrs=attributes)
+        if soup is None:
+            return None
+    return soup
+
+
+class SubtreeCollector(HTMLParser):
+    """
+    Incremental parser that collects the HTML of the first element matching a search step
+    and stops as soon as the element is closed
+    """
+
+    def __init__(self, step):
+        """
+        Create the collector
+        :param step: The compiled search step (tag name, attributes)
+        """
+        super().__init__(convert_charrefs=False)
+        self.tag, self.attributes = step
+        self.parts = []
+        self.captured = None
+        self.depth = 0
+        self.done = False
+
+    @property
+    def fragment(self):
+        """
+        The HTML of the matched element, None if not found yet
+        """
+        return "".join(self.parts) if self.parts else None
+
+    def matches(self, tag, attrs):
+        if self.tag and tag != self.tag:
+            return False
+        values = dict(attrs)
+        for attribute, expected in self.attributes.items():
+            value = values.get(attribute)
+            if value is None or (value != expected and expected not in value.split()):
+                return False
+        return True
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if self.depth:
+            self.parts.append(self.get_starttag_text())
+            if tag == self.captured:
+                self.depth += 1
+        elif self.matches(tag, attrs):
+            self.captured = tag
+            self.parts.append(self.get_starttag_text())
+            self.depth = 1
+
+    def handle_startendtag(self, tag, attrs):
+        if self.depth and not self.done:
+            self.parts.append(self.get_starttag_text())
+        elif not self.done and self.matches(tag, attrs):
+            self.parts.append(self.get_starttag_text())
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if self.depth and not self.done:
+            self.parts.append(f"</{tag}>")
+            if tag == self.captured:
+                self.depth -= 1
+                self.done = self.depth == 0
+
+    def handle_data(self, data):
+        if self.depth and not self.done:
+            self.parts.append(data)
+
+    def handle_entityref(self, name):
+        if self.depth and not self.done:
+            self.parts.append(f"&{name};")
+
+    def handle_charref(self, name):
+        if self.depth and not self.done:
+            self.parts.append(f"&#{name};")
+
+    def handle_comment(self, data):
+        if self.depth and not self.done:
+            self.parts.append(f"<!--{data}-->")
+
+
+class ExtractionPlan:
+    """
+    The search_steps/search_element section of a download configuration, compiled once.
+    The page is parsed only within the subtree matched by the first search step
+    """
+
+    def __init__(self, section, logging_handler, name=""):
+        """
+        Compile the configuration section
+        :param section: The configuration section (List or Download)
+        :param logging_handler: A logging instance
+        :param name: The configuration name, used in the logs
+        """
+        self.logging = logging_handler
+        self.name = name
+        self.steps = [compile_step(step) for step in section.get("search_steps", [])]
+        search_element = section.get("search_element") or {}
+        element = search_element.get('element', None)
+        self.element = compile_step(element) if element is not None else None
+        self.extractions = []
+        for extraction_info in search_element.get('extract', []):
+            further_steps = extraction_info.get("steps", [])
+            self.extractions.append((
+                extraction_info["key"],
+                extraction_info.get('value'),
+                [compile_step(step) for step in further_steps],
+                further_steps
+            ))
+        self.strainer = None
+        if self.steps and (self.steps[0][0] or self.steps[0][1]):
+            self.strainer = SoupStrainer(self.steps[0][0], self.steps[0][1])
+
+    def parse(self, content, from_encoding=None):
+        """
+        Parse only the relevant part of a page
+        :param content: The page content
+        :param from_encoding: The page encoding, if known
+        :return: The parsed document
+        """
+        return BeautifulSoup(content, HTML_PARSER, parse_only=self.strainer, from_encoding=from_encoding)
+
+    def extract(self, content, from_encoding=None):
+        """
+        Extract the information from a page
+        :param content: The page content
+        :param from_encoding: The page encoding, if known
+        :return: The list of extracted elements
+        :raise AttributeError: If the section containing the elements cannot be found
+        """
+        return self.extract_from(self.parse(content, from_encoding))
+
+    def extract_stream(self, chunks, encoding=None):
+        """
+        Extract the information from a page while it is downloaded.
+        Only the element matched by the first search step is parsed, and the download stops once it is closed
+        :param chunks: An iterator over the page content
+        :param encoding: The page encoding (UTF-8 if None)
+        :return: The list of extracted elements
+        :raise AttributeError: If the section containing the elements cannot be found
+        """
+        if self.strainer is None:
+            # Without a first step to look for the whole page is needed
+            return self.extract(b"".join(chunks), encoding)
+        collector = SubtreeCollector(self.steps[0])
+        decoder = codecs.getincrementaldecoder(encoding or "utf-8")(errors="replace")
+        for chunk in chunks:
+            collector.feed(decoder.decode(chunk))
+            if collector.done:
+                break
+        else:
+            collector.feed(decoder.decode(b"", final=True))
+            collector.close()
+        if collector.fragment is None:
+            raise AttributeError("Cannot find the first search step")
+        return self.extract_from(BeautifulSoup(collector.fragment, HTML_PARSER))
+
+    def extract_from(self, soup):
+        """
+        Extract the information from a parsed page
+        :param soup: The parsed page
+        :return: The list of extracted elements
+        :raise AttributeError: If the section containing the elements cannot be found
+        """
+        if self.element is None:
+            self.logging.warning("extractInfo - Missing search element")
+            return []
+        mainSection = run_steps(soup, self.steps)
+        if mainSection is None:
+            raise AttributeError("Cannot execute the search steps")
+        info = []
+        html_type, attributes = self.element
+        for html_element in mainSection.find_all(name=html_type, attrs=attributes):
+            info_element = {}
+            for key, searched_value, steps, further_steps in self.extractions:
+                info_element[key] = self.extract_data(html_element, searched_value, steps, further_steps)
+            if info_element:
+                info.append(info_element)
+        return info
+
+    def extract_data(self, html_element, searched_value, steps, further_steps):
+        """
+        Extract a single value from an element
+        :param html_element: The element
+        :param searched_value: What to extract ("href" or "text")
+        :param steps: The compiled steps to reach the value
+        :param further_steps: The original steps, used in the logs
+        :return: The extracted value, None if missing
+        """
+        soup = run_steps(html_element, steps)
+        if soup is None:
+            self.logging.warning(f"extractData - Cannot execute the following steps: {str(further_steps)}")
+            return None
+        if searched_value == "href":
+            return soup["href"]
+        elif searched_value == "text":
+            return soup.text
+        else:
+            self.logging.warning(f"{self.name} - extractData - Invalid value to extract [{searched_value}]")
+            return None
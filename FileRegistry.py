@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+import json
+import os
+
+
+class JsonFileStore:
+    """
+    Stores the list of managed files inside a json snapshot plus an append-only journal.
+    Every change is appended to the journal (constant cost per file), while the snapshot is
+    rewritten atomically only when the journal is compacted.
+    Exposes the same interface of DbConnector so that both can back a FileRegistry
+    """
+
+    COMPACT_AFTER = 1000
+    """
+    Number of journal entries that triggers a compaction
+    """
+
+    def __init__(self, file_path, logging_handler, compact_after=COMPACT_AFTER):
+        self.filePath = file_path
+        self.journalPath = file_path + ".journal"
+        self.logging = logging_handler
+        self.compactAfter = compact_after
+        self.journalEntries = 0
+        self.files = {}
+
+    def getFiles(self):
+        """
+        Read the stored file list, replaying the journal over the last snapshot
+        :return: The list of already managed files
+        """
+        self.files = dict.fromkeys(self.read_snapshot())
+        self.journalEntries = self.replay_journal()
+        if self.journalEntries:
+            self.logging.info(f"JsonFileStore - Recovered {self.journalEntries} journal entries")
+            self.compact()
+        return list(self.files)
+
+    def read_snapshot(self):
+        """
+        Read the last json snapshot
+        :return: The list of files in the snapshot
+        """
+        try:
+            with open(self.filePath) as json_file:
+                return json.load(json_file)
+        except ValueError:
+            self.logging.warning('Cannot decode the stored file list - Using an empty one')
+            print("Invalid json [" + str(self.filePath) + "] - Use empty one")
+        except FileNotFoundError:
+            self.logging.warning('Stored file list not found - Using an empty one')
+            print("File list not existent [" + str(self.filePath) + "] - Using an empty one")
+        return []
+
+    def replay_journal(self):
+        """
+        Apply the journal entries to the loaded files
+        :return: The number of entries read
+        """
+        entries = 0
+        try:
+            with open(self.journalPath) as journal:
+                for line in journal:
+                    try:
+                        operation, filename = json.loads(line)
+                    except ValueError:
+                        # Only the last entry can be torn by a crash during the append
+                        self.logging.warning(f"JsonFileStore - Skipping corrupted journal entry [{line.strip()}]")
+                        entries += 1
+                        continue
+                    if operation == "+":
+                        self.files[filename] = None
+                    elif operation == "-":
+                        self.files.pop(filename, None)
+                    entries += 1
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def iterFiles(self):
+        """
+        Iterate over the stored file list
+        :return: An iterator over the already managed files
+        """
+        return iter(self.getFiles())
+
+    def insertFile(self, filename):
+        """
+        Add a file to the stored list
+        :param filename: The file to add
+        :return: None
+        """
+        self.insertFiles([filename])
+
+    def insertFiles(self, filenames):
+        """
+        Add many files to the stored list with a single journal write
+        :param filenames: The files to add
+        :return: None
+        """
+        filenames = [str(f) for f in filenames]
+        for filename in filenames:
+            self.files[filename] = None
+        self.append_journal("+", filenames)
+
+    def removeFile(self, filename):
+        """
+        Remove a file from the stored list
+        :param filename: The file to remove
+        :return: None
+        """
+        filename = str(filename)
+        self.files.pop(filename, None)
+        self.append_journal("-", [filename])
+
+    def append_journal(self, operation, filenames):
+        """
+        Append the given operation to the journal, compacting it when too long
+        :param operation: "+" to add files, "-" to remove them
+        :param filenames: The files involved
+        :return: None
+        """
+        if not filenames:
+            return
+        with open(self.journalPath, "a") as journal:
+            journal.write("".join(json.dumps([operation, f]) + "\n" for f in filenames))
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.journalEntries += len(filenames)
+        if self.journalEntries >= self.compactAfter:
+            self.compact()
+
+    def compact(self):
+        """
+        Atomically replace the snapshot with the current file list and empty the journal
+        :return: None
+        """
+        tmp_path = self.filePath + ".tmp"
+        with open(tmp_path, "w") as json_file:
+            json.dump(list(self.files), json_file)
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        os.replace(tmp_path, self.filePath)
+        # The journal is emptied only once the new snapshot is durable
+        with open(self.journalPath, "w") as journal:
+            os.fsync(journal.fileno())
+        self.journalEntries = 0
+        self.logging.info(f"JsonFileStore - Compacted file list [{len(self.files)} files]")
+
+
+class FileRegistry:
+    """
+    In-memory index of the already managed files, kept in sync with a persistent store.
+    The store is loaded once, then every change is applied to both the index and the store
+    """
+
+    files: set
+    """
+    The names of the files already managed
+    """
+
+    def __init__(self, store, logging_handler):
+        """
+        Create the registry
+        :param store: The persistent store (DbConnector or JsonFileStore)
+        :param logging_handler: A logging instance
+        """
+        self.store = store
+        self.logging = logging_handler
+        self.files = set()
+        self.loaded = False
+
+    def load(self, force=False):
+        """
+        Load the managed files from the store
+        :param force: Reload the files even if already loaded
+        :return: The registry itself
+        """
+        if force or not self.loaded:
+            self.files = set(self.store.iterFiles())
+            self.loaded = True
+            self.logging.info(f"FileRegistry - Loaded {len(self.files)} managed files")
+        return self
+
+    def add(self, filename):
+        """
+        Mark a file as managed
+        :param filename: The file to add
+        :return: True if the file was not managed yet, False otherwise
+        """
+        filename = str(filename)
+        if filename in self.files:
+            return False
+        self.files.add(filename)
+        self.store.insertFile(filename)
+        return True
+
+    def add_many(self, filenames):
+        """
+        Mark many files as managed, persisting them with a single store operation
+        :param filenames: The files to add
+        :return: The files that were not managed yet
+        """
+        added = []
+        for filename in map(str, filenames):
+            if filename not in self.files:
+                self.files.add(filename)
+                added.append(filename)
+        if added:
+            self.store.insertFiles(added)
+        return added
+
+    def remove(self, filename):
+        """
+        Mark a file as not managed
+        :param filename: The file to remove
+        :return: True if the file was managed, False otherwise
+        """
+        filename = str(filename)
+        if filename not in self.files:
+            return False
+        self.files.discard(filename)
+        self.store.removeFile(filename)
+        return True
+
+    def __contains__(self, filename):
+        return str(filename) in self.files
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        return iter(self.files)
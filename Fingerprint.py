@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+import collections
+import hashlib
+import os
+import threading
+
+# Bytes read for each step while hashing a file
+CHUNK_SIZE = 1024 * 1024
+
+# Fingerprints remembered, the least recently used are dropped first
+MAX_CACHED = 1024
+
+# Path -> (size, mtime, fingerprint) - Only the latest version of each file is kept
+_cache = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def file_fingerprint(file_path):
+    """
+    Compute the content fingerprint of a file (SHA-256 of its bytes).
+    The result is remembered until the file size or modification time changes, for the MAX_CACHED files used last
+    :param file_path: The file to hash
+    :return: The hex digest of the file content
+    """
+    stat = os.stat(file_path)
+    path = os.path.abspath(file_path)
+    version = (stat.st_size, stat.st_mtime_ns)
+    with _lock:
+        cached = _cache.get(path)
+        if cached and cached[:2] == version:
+            _cache.move_to_end(path)
+            return cached[2]
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    fingerprint = digest.hexdigest()
+    with _lock:
+        _cache[path] = version + (fingerprint,)
+        _cache.move_to_end(path)
+        while len(_cache) > MAX_CACHED:
+            _cache.popitem(last=False)
+    return fingerprint
@@ -1,17 +1,61 @@
 #!/usr/bin/env python3
 import asyncio
+import math
 import os
 import time
-import tomllib
-import requests
-import json
+from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError, wait
 import telegram
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from AsyncScheduler import AsyncScheduler
 from DbConnector import DbConnector
+from FileRegistry import FileRegistry, JsonFileStore
+import telethon.errors
 from telethon import TelegramClient
-from GiornalettiereDownloader import GiornalettiereDownloader
-from DirectoryWatcher.DirectoryWatcher import DirectoryWatcher
+from telethon.tl.types import InputDocument
+from DownloadConfigRegistry import DownloadConfigRegistry
+from DownloadSubmitter import DownloadSubmitter
+from UploadQueue import UploadQueue
+from UploadScheduler import UploadScheduler
+from ParallelUploader import ParallelUploader, BIG_FILE_MIN_SIZE, MAX_FILE_SIZE
+from Fingerprint import file_fingerprint
+from DirectoryWatcher.DirectoryScanner import DirectoryScanner
+from DirectoryWatcher.StabilityTracker import StabilityTracker
+from Metrics import REGISTRY, MetricsServer
+from Profiling import HandlerTracer, SamplingProfiler
+
+
+# Files of this size or bigger cannot be sent through the bot API - https://core.telegram.org/bots/faq#how-do-i-upload-a-large-file
+BOT_API_MAX_SIZE = 52428800  # 50MB
+
+# Seconds between two checks of the Telegram client session, and time allowed to each check
+CLIENT_HEALTH_CHECK_INTERVAL = 60
+CLIENT_HEALTH_CHECK_TIMEOUT = 10
+
+# Most files grouped in a single album by Telegram
+ALBUM_SIZE = 10
+
+# Parts of a big upload acknowledged by Telegram and recorded in the DB at once (32MB with the default part size)
+UPLOAD_PART_BATCH = 64
+
+# Kinds of Telegram references stored for the uploaded contents
+BOT_FILE_ID = "bot"
+MTPROTO_FILE_ID = "mtproto"
+SPLIT_FILE_ID = "split"
+
+# Methods traced together with the bot handlers, since they also run as scheduled jobs
+TRACED_METHODS = ("fetch_data", "update_channel")
+
+CHECK_SECONDS = REGISTRY.histogram("giornalettiere_check_new_files_seconds", "Time spent looking for new files")
+SOURCE_SECONDS = REGISTRY.histogram("giornalettiere_source_seconds", "Time spent searching each download configuration", ["source"])
+# Seconds a source can run past its timeout, to end the requests in flight, before fetch_data stops waiting for it
+SOURCE_TIMEOUT_MARGIN = 30
+
+# Seconds between two checks of the sources still running
+SOURCE_CHECK_INTERVAL = 1
+
+SOURCE_FAILURES = REGISTRY.counter("giornalettiere_source_failures_total", "Searches failed or timed out", ["source"])
 
 
 # Check if the given path is an absolute path
@@ -22,24 +66,42 @@ def create_absolute_path(path: str):
     return path
 
 
+# Serialize the reference of a document sent by the client - The file reference is needed to send it again
+def pack_document(document):
+    return f"{document.id}:{document.access_hash}:{document.file_reference.hex()}"
+
+
+# Rebuild the InputDocument of a reference serialized by pack_document
+def unpack_document(reference: str):
+    document_id, access_hash, file_reference = reference.split(":")
+    return InputDocument(int(document_id), int(access_hash), bytes.fromhex(file_reference))
+
+
 class Giornalettiere:
     client: TelegramClient
     """
-    The Telegram client used to upload files bigger than 50MB
+    The Telegram client used to upload files bigger than 50MB - Kept connected across uploads
     """
 
-    myFileList: list
+    myFileList: FileRegistry
     """
-    The list of files already managed
+    The registry of files already managed
     """
 
-    def __init__(self, config, logging_handler):
+    uploadQueue: UploadQueue
+    """
+    The persistent queue of the files found but not delivered yet
+    """
+
+    def __init__(self, config, logging_handler, settings_dir="Settings", download_config_dir="DownloadConfig"):
         """
         Load config and psw
         :param config: The configuration object
         :param logging_handler: A logging instance
+        :param settings_dir: The directory containing the file list, the DB and the sessions
+        :param download_config_dir: The directory containing the download configurations
         """
-        all_settings_dir = "Settings"
+        all_settings_dir = settings_dir
         file_list_path = "myFileList.json"
         giornalettiere_db = "Giornalettiere.db"
 
@@ -53,16 +115,143 @@ class Giornalettiere:
         # Insert default values
         if 'json_db' not in self.localParameters['Download']:
             self.localParameters['Download']['json_db'] = False
+        if 'settleInterval' not in self.localParameters['Download']:
+            self.localParameters['Download']['settleInterval'] = 1
+        if 'watcherDebounce' not in self.localParameters['Download']:
+            self.localParameters['Download']['watcherDebounce'] = 2
+        if 'sourceWorkers' not in self.localParameters['Download']:
+            self.localParameters['Download']['sourceWorkers'] = 8
+        if 'sourceTimeout' not in self.localParameters['Download']:
+            self.localParameters['Download']['sourceTimeout'] = 120
+        if 'maxUploadAttempts' not in self.localParameters['Download']:
+            self.localParameters['Download']['maxUploadAttempts'] = 5
+        if 'retryBackoff' not in self.localParameters['Download']:
+            self.localParameters['Download']['retryBackoff'] = 30
+        if 'maxRetryBackoff' not in self.localParameters['Download']:
+            self.localParameters['Download']['maxRetryBackoff'] = 3600
+        if 'uploadLease' not in self.localParameters['Download']:
+            self.localParameters['Download']['uploadLease'] = 60
+        if 'maxSettleHours' not in self.localParameters['Download']:
+            self.localParameters['Download']['maxSettleHours'] = 24
+        if 'submitWindow' not in self.localParameters['Download']:
+            self.localParameters['Download']['submitWindow'] = 2
+        if 'submitRetries' not in self.localParameters['Download']:
+            self.localParameters['Download']['submitRetries'] = 5
+        if 'submitDedupHours' not in self.localParameters['Download']:
+            self.localParameters['Download']['submitDedupHours'] = 12
         if 'debug_useOnlyClient' not in self.localParameters['Telegram']:
             self.localParameters['Telegram']['debug_useOnlyClient'] = False
+        if 'smallUploadWorkers' not in self.localParameters['Telegram']:
+            self.localParameters['Telegram']['smallUploadWorkers'] = 4
+        if 'bigUploadWorkers' not in self.localParameters['Telegram']:
+            self.localParameters['Telegram']['bigUploadWorkers'] = 1
+        if 'uploadPartsInFlight' not in self.localParameters['Telegram']:
+            # Formerly named uploadConnections, although the parts always shared the client connection
+            self.localParameters['Telegram']['uploadPartsInFlight'] = \
+                self.localParameters['Telegram'].get('uploadConnections', 4)
+        if 'splitSize' not in self.localParameters['Telegram']:
+            self.localParameters['Telegram']['splitSize'] = MAX_FILE_SIZE // (1024 * 1024)
+        if 'botApiUrl' not in self.localParameters['Telegram']:
+            self.localParameters['Telegram']['botApiUrl'] = ""
+        if 'admins' not in self.localParameters['Telegram']:
+            self.localParameters['Telegram']['admins'] = []
+        if 'Profiling' not in self.localParameters:
+            self.localParameters['Profiling'] = {}
+        if 'traceHandlers' not in self.localParameters['Profiling']:
+            self.localParameters['Profiling']['traceHandlers'] = False
+        if 'profileAtStartup' not in self.localParameters['Profiling']:
+            self.localParameters['Profiling']['profileAtStartup'] = 0
+        if 'sampleInterval' not in self.localParameters['Profiling']:
+            self.localParameters['Profiling']['sampleInterval'] = 0.01
+        if 'maxProfileSeconds' not in self.localParameters['Profiling']:
+            self.localParameters['Profiling']['maxProfileSeconds'] = 300
+        if 'Metrics' not in self.localParameters:
+            self.localParameters['Metrics'] = {}
+        if 'address' not in self.localParameters['Metrics']:
+            self.localParameters['Metrics']['address'] = "127.0.0.1"
+        if 'port' not in self.localParameters['Metrics']:
+            self.localParameters['Metrics']['port'] = 9464
 
         # Define File List
         self.db = DbConnector(giornalettiere_db, self.logging)
         self.fileListPath = create_absolute_path(os.path.join(all_settings_dir, file_list_path))
+        if self.localParameters['Download']['json_db']:
+            store = JsonFileStore(self.fileListPath, self.logging)
+        else:
+            store = self.db
+        self.myFileList = FileRegistry(store, self.logging)
         self.read_file_list()
+        self.scanner = DirectoryScanner(str(os.path.join(
+            self.localParameters['Download']['fileLocation'],
+            self.localParameters['Download']['downloadRequest']
+        )), self.logging)
+        self.scanLock = asyncio.Lock()
+        self.stabilityTracker = StabilityTracker(self.localParameters['Download']['settleInterval'], self.logging)
+        self.uploadScheduler = UploadScheduler(
+            self.send_small_document,
+            self.send_big_document,
+            self.logging,
+            BOT_API_MAX_SIZE,
+            self.localParameters['Telegram']['smallUploadWorkers'],
+            self.localParameters['Telegram']['bigUploadWorkers'],
+            self.localParameters['Telegram']['debug_useOnlyClient']
+        )
+        # TODO Define a message for each file (es. hashtag, date)
+        self.uploadQueue = UploadQueue(
+            self.db,
+            self.stabilityTracker,
+            self.uploadScheduler,
+            self.logging,
+            self.localParameters['Telegram']['myChannel'],
+            lambda path: self.add_to_file_list(os.path.basename(path)),
+            self.localParameters['Download']['maxUploadAttempts'],
+            self.localParameters['Download']['retryBackoff'],
+            self.localParameters['Download']['maxRetryBackoff'],
+            self.localParameters['Download']['uploadLease'],
+            self.localParameters['Download']['maxSettleHours'] * 3600
+        )
+
+        REGISTRY.gauge("giornalettiere_managed_files", "Files already managed").set_function(lambda: len(self.myFileList))
+        self.metricsServer = MetricsServer(
+            REGISTRY,
+            self.localParameters['Metrics']['address'],
+            self.localParameters['Metrics']['port'],
+            self.logging
+        )
+        self.scheduler = AsyncScheduler(self.logging)
+        self.tracer = HandlerTracer(self.logging)
+        self.profiler = SamplingProfiler(self.logging, self.localParameters['Profiling']['sampleInterval'])
+
+        # Define download sources
+        self.httpCacheDir = create_absolute_path(os.path.join(all_settings_dir, "http_cache"))
+        self.downloadConfigs = DownloadConfigRegistry(download_config_dir, self.logging, self.httpCacheDir)
+        self.downloadSubmitter = DownloadSubmitter(
+            self.localParameters['Download']['downloadSite'],
+            self.localParameters['Download']['downloadRequest'],
+            self.logging,
+            self.localParameters['Download']['submitWindow'],
+            self.localParameters['Download']['submitRetries'],
+            self.localParameters['Download']['submitDedupHours'] * 3600
+        )
 
         # Connecting to Telegram
-        self.application = Application.builder().token(self.localParameters['Telegram']['telegram_token']).build()
+        self.loop = None
+        self.client = None
+        self.clientLock = asyncio.Lock()
+        self.clientCheckedAt = 0
+        # Files bigger than this are sent as numbered parts - The client cannot upload more than MAX_FILE_SIZE at once
+        # The parts of a split file are bigger than half the split size, and cannot be smaller than BIG_FILE_MIN_SIZE
+        self.splitSize = min(MAX_FILE_SIZE, max(2 * BIG_FILE_MIN_SIZE,
+                                                int(self.localParameters['Telegram']['splitSize']) * 1024 * 1024))
+        builder = Application.builder() \
+            .token(self.localParameters['Telegram']['telegram_token']) \
+            .post_init(self.post_init) \
+            .post_shutdown(self.post_shutdown)
+        bot_api_url = self.localParameters['Telegram']['botApiUrl'].rstrip("/")
+        if bot_api_url:
+            # Local Bot API server - https://github.com/tdlib/telegram-bot-api
+            builder = builder.base_url(bot_api_url + "/bot").base_file_url(bot_api_url + "/file/bot")
+        self.application = builder.build()
         self.bot = self.application.bot
         self.logging.info("Connected successfully to Telegram")
 
@@ -70,124 +259,81 @@ class Giornalettiere:
         """
         Check if new files are present in the directory
         :return: The list of file from directory.<br>
-                Filtered only interesting (no already uploaded, no wrong file extension)
+                Filtered only interesting (no already uploaded, no wrong file extension).<br>
+                Files are added to the list of already managed only once delivered
         """
-        new_files = []
+        started = time.perf_counter()
         self.read_file_list()
-        observed_dir = str(os.path.join(
-            self.localParameters['Download']['fileLocation'],
-            self.localParameters['Download']['downloadRequest']
-        ))
-        self.logging.info("checkNewFiles - checking new file in [" + observed_dir + "]")
-        for root, dirs, files in os.walk(observed_dir):
-            for file in files:
-                # Check file extension
-                if file.endswith(tuple(self.localParameters['Download']["filetypes"])):
-                    # Check if file is new
-                    if file not in self.myFileList:
-                        found_new = os.path.join(root, file)
-                        self.logging.info("checkNewFiles - Found new file [" + found_new + "]")
-                        new_files.append(found_new)
-                        self.add_to_file_list(file)
+        filetypes = tuple(self.localParameters['Download']["filetypes"])
+        self.logging.info("checkNewFiles - checking new file in [" + self.scanner.root + "]")
+        new_files = []
+        for root, file in self.scanner.scan():
+            # Check file extension
+            if file.endswith(filetypes):
+                # Check if file is new
+                if file not in self.myFileList:
+                    found_new = os.path.join(root, file)
+                    self.logging.info("checkNewFiles - Found new file [" + found_new + "]")
+                    new_files.append(found_new)
+        CHECK_SECONDS.observe(time.perf_counter() - started)
         self.logging.info('File research concluded')
         return new_files
 
-    def sync_update_channel(self, file_found=""):
-        self.logging.info("sync_update_channel - Start checking for new files")
-        asyncio.run(self.update_channel(file_found))
-        self.logging.info("sync_update_channel - Finished updating channel")
+    def request_update(self, files_found=None):
+        """
+        Schedule a channel update on the bot event loop - Can be called from any thread
+        :param files_found: The files that have triggered the update
+        :return: The concurrent Future of the update, None if the bot is not running yet
+        """
+        if self.loop is None or self.loop.is_closed():
+            self.logging.warning("request_update - Bot not running - Update skipped")
+            return None
+        return asyncio.run_coroutine_threadsafe(self.update_channel(files_found), self.loop)
 
-    async def update_channel(self, file_found=""):
+    async def update_channel(self, files_found=None):
         """
         Updates the channel sending new files
-        :param file_found: The file that has triggered the update
+        :param files_found: The file (or the list of files) that has triggered the update
         :return: None
         """
-        if file_found:
-            self.logging.info("update_channel - Update triggered by this file [" + file_found + "]")
+        if files_found:
+            if isinstance(files_found, str):
+                files_found = [files_found]
+            self.logging.info("update_channel - Update triggered by these files [" + ", ".join(files_found) + "]")
         self.logging.info("update_channel - Start checking for new files")
-        new_files = self.check_new_files()
+        # The scan runs in a worker thread, one at a time
+        async with self.scanLock:
+            new_files = await asyncio.to_thread(self.check_new_files)
         self.logging.info("update_channel - Found " + str(len(new_files)) + " new files")
-        while new_files:
-            # Attempts to send only completed files
-            new_files = list(set(new_files) - set(await self.send_file_list(new_files)))
-            self.logging.info("update_channel - Waiting to send " + str(len(new_files)) + " new files")
+        if new_files:
+            # The upload queue sends the files as soon as they are completed
+            self.uploadQueue.discover(new_files)
         self.logging.info('update_channel - Done')
 
-    async def send_file_list(self, file_list):
-        """
-        Attempt to send the completed files
-        :param file_list: The complete list of files to send
-        :return: The list of sent files
-        """
-        sent_files = []
-        for newFile in file_list:
-            # Wait for new file
-            if DirectoryWatcher.stable_size(newFile):
-                self.logging.info("update_channel - The new file is: " + str(newFile))
-                # TODO Define a message for each file (es. hashtag, date)
-                message = ""
-                await self.send_document(
-                    self.localParameters['Telegram']['myChannel'],
-                    newFile,
-                    message
-                )
-                sent_files.append(newFile)
-        return sent_files
-
-    def read_file_list(self):
+    def read_file_list(self, force=False):
         """
         Read my file list
-        :return: The list of already managed files
-        """
-        if self.localParameters['Download']['json_db']:
-            return self.read_json_file_list()
-        else:
-            self.myFileList = self.db.getFiles()
-            self.logging.info('File list loaded from DB')
-            return self.myFileList
-
-    def read_json_file_list(self):
-        """
-        Read my file list as a json
-        :return: The list of already managed files
+        :param force: Reload the list from the store even if already loaded
+        :return: The registry of already managed files
         """
-        try:
-            with open(self.fileListPath) as json_file:
-                self.myFileList = json.load(json_file)
-        except ValueError:
-            self.logging.warning('Cannot decode the stored file list - Using an empty one')
-            print("Invalid json [" + str(self.fileListPath) + "] - Use empty one")
-            self.myFileList = []
-        except FileNotFoundError:
-            self.logging.warning('Stored file list not found - Using an empty one')
-            print("File list not existent [" + str(self.fileListPath) + "] - Using an empty one")
-            self.myFileList = []
+        self.myFileList.load(force)
         self.logging.info('File list loaded')
         return self.myFileList
 
-    def dump_file_list(self):
-        """
-        Updates the file list stored in the json
-        :return: None
-        """
-        with open(self.fileListPath, "w") as json_file:
-            json.dump(self.myFileList, json_file)
-
-    def add_to_file_list(self, filename: str):
+    def add_to_file_list(self, filename):
         """
         Add a file to the file list
-        :param filename: Add a new file to the list of already managed
+        :param filename: Add a new file (or a list of files) to the list of already managed
         :return: None
         """
+        if isinstance(filename, list):
+            added = self.myFileList.add_many(filename)
+            if added:
+                self.logging.info('Appended ' + str(len(added)) + ' files to file list [' + ', '.join(added) + ']')
+            return
         filename = str(filename)
-        self.myFileList.append(filename)
-        if self.localParameters['Download']['json_db']:
-            self.dump_file_list()
-            self.logging.info('Appended to JSON file list [' + str(filename) + ']')
-        else:
-            self.db.insertFile(filename)
-            self.logging.info('Appended to DB file list [' + str(filename) + ']')
+        if self.myFileList.add(filename):
+            self.logging.info('Appended to file list [' + filename + ']')
 
     def remove_from_file_list(self, filename: str):
         """
@@ -197,12 +343,10 @@ class Giornalettiere:
         """
         filename = str(filename)
         self.logging.info("removeFromFileList - Element before: " + str(len(self.myFileList)))
-        self.myFileList.remove(filename)
+        if self.myFileList.remove(filename):
+            # The file must be reported again by the next scan
+            self.scanner.reset()
         self.logging.info("removeFromFileList - Element after: " + str(len(self.myFileList)))
-        if self.localParameters['Download']['json_db']:
-            self.dump_file_list()
-        else:
-            self.db.removeFile(filename)
 
     def start(self):
         """
@@ -211,6 +355,8 @@ class Giornalettiere:
         """
         # Defining handlers
         self.create_handlers()
+        self.downloadConfigs.watch()
+        self.metricsServer.start()
         self.logging.info("Bot handlers created")
         print("Bot handlers created")
         # Starting bot
@@ -235,12 +381,42 @@ class Giornalettiere:
                     f"Network error: {e}. Retrying in {wait_time:.2f} seconds (attempt {retry_count}/{max_retries})")
                 time.sleep(wait_time)
 
+    async def post_init(self, application: Application):
+        """
+        Called once the bot event loop is running
+        :param application: The running application
+        :return: None
+        """
+        self.loop = asyncio.get_running_loop()
+        self.downloadSubmitter.start(self.loop)
+        self.scheduler.start()
+        self.uploadQueue.start()
+        if self.localParameters['Profiling']['traceHandlers']:
+            self.tracer.enable(application, self, TRACED_METHODS)
+        if self.localParameters['Profiling']['profileAtStartup']:
+            application.create_task(self.run_profile(self.localParameters['Profiling']['profileAtStartup']))
+        self.logging.info("Bot event loop ready")
+
+    async def post_shutdown(self, application: Application):
+        """
+        Called once the bot stopped, before the event loop is closed
+        :param application: The stopped application
+        :return: None
+        """
+        await self.scheduler.stop()
+        await self.uploadQueue.stop()
+        await self.downloadSubmitter.stop()
+        if self.client is not None:
+            await self.client.disconnect()
+        self.logging.info("Bot event loop closed")
+
     def stop(self):
         """
         Stop the daemon
         :return: None
         """
         self.application.stop()
+        self.metricsServer.stop()
         self.logging.info("Bot is now stopped")
 
     async def send_message(self, message, chat=None, parse_mode=None):
@@ -269,18 +445,16 @@ class Giornalettiere:
         :param chat: The chat id the file will be sent to
         :param file_path: The file to send
         :param message: The message to send with the file
-        :return: None
+        :return: True if the document has been delivered
         """
-        max_size = 52428800  # 50MB - https://core.telegram.org/bots/faq#how-do-i-upload-a-large-file
-        if os.path.getsize(file_path) >= max_size or self.localParameters['Telegram']['debug_useOnlyClient']:
+        if self.uploadScheduler.choose_lane(os.path.getsize(file_path)) == UploadScheduler.MTPROTO_LANE:
             self.logging.info("send_document - Sending big document using telethon library")
-            # loop = asyncio.new_event_loop()
-            # asyncio.set_event_loop(loop)
-            # loop.run_until_complete(self.send_big_document(file_path, message, chat))
-            await self.send_big_document(file_path, message, chat)
+            delivered = await self.send_big_document(file_path, message, chat)
         else:
-            await self.send_small_document(file_path, message, chat)
-        self.logging.info("send_document - Document sent")
+            delivered = await self.send_small_document(file_path, message, chat)
+        if delivered:
+            self.logging.info("send_document - Document sent")
+        return delivered
 
     async def send_small_document(self, file_path, message, chat):
         """
@@ -288,11 +462,27 @@ class Giornalettiere:
         :param file_path: The file to send
         :param message: The message to send with the file
         :param chat: The chat id the file will be sent to
-        :return:
+        :return: True if the document has been delivered
         """
         try:
+            fingerprint = await asyncio.to_thread(file_fingerprint, file_path)
+            file_id = self.db.getFileId(fingerprint, BOT_FILE_ID)
+            if file_id:
+                try:
+                    await self.bot.send_document(
+                        chat_id=chat,
+                        document=file_id,
+                        caption=message,
+                        disable_notification=False,
+                        parse_mode=telegram.constants.ParseMode.MARKDOWN_V2
+                    )
+                    self.logging.info(f"send_small_document - File sent by reference [{file_path}]")
+                    return True
+                except telegram.error.BadRequest as err:
+                    self.logging.warning(f"send_small_document - Stored file id refused [{err}] - Uploading again")
+                    self.db.removeFileId(fingerprint, BOT_FILE_ID)
             with open(file_path, 'rb') as document:
-                await self.bot.send_document(
+                sent = await self.bot.send_document(
                     chat_id=chat,
                     document=document,
                     caption=message,
@@ -300,6 +490,9 @@ class Giornalettiere:
                     parse_mode=telegram.constants.ParseMode.MARKDOWN_V2
                 )
                 self.logging.info(f"send_small_document - File sent [{file_path}]")
+            if sent.document:
+                self.db.storeFileId(fingerprint, BOT_FILE_ID, sent.document.file_id)
+            return True
         except telegram.error.BadRequest as err:
             self.logging.error(
                 f"send_small_document - BadRequest - Cannot send message to chat [{chat}][{err}] - Skip")
@@ -308,53 +501,203 @@ class Giornalettiere:
             self.remove_from_file_list(chat)
         except Exception as e:  # Usa Exception invece di telegram.error (che non è un'eccezione)
             self.logging.error(f"send_small_document - Generic error: {e}")
+        return False
 
     async def send_big_document(self, file_path, message, chat):
         """
-        Send the file using the client instead of the bot
+        Send the file using the client instead of the bot - Files bigger than the split size are sent in parts
         :param file_path: The file to send
         :param message: The message to send with the file
         :param chat: The chat id the file will be sent to
-        :return: None
+        :return: True if the document has been delivered
         """
+        size = os.path.getsize(file_path)
+        split = size > self.splitSize
+        kind = SPLIT_FILE_ID if split else MTPROTO_FILE_ID
         try:
             self.logging.info("Attempting upload using client")
-            session_file = create_absolute_path(os.path.join(self.settingDir, 'bot_session.session'))
-            await self.connect_to_telegram_client(session_file)
-            # Assicurati che il client sia connesso
-            if not self.client.is_connected():
-                self.logging.info("Client not connected, connecting now")
-                await self.client.connect()
-
-                # Se necessario, effettua il login
-                if not await self.client.is_user_authorized():
-                    self.logging.warning("Client not authorized, authentication needed")
-                    # Implementa la logica di autenticazione se necessario
-                    # Questo passaggio potrebbe richiedere intervento umano
-
+            client = await self.get_telegram_client()
             chat = self.get_chat_parsed(chat)
             self.logging.debug("Attempting sending message to chat [" + str(chat) + "] with message [" + message + "]")
-            # Gestisci potenziali errori di connessione
-            try:
-                msg1 = await self.client.send_message(chat, 'Nuovo giornale in arrivo...')
-                self.logging.debug(
-                    f"Attempting sending [{file_path}] to chat [{chat}] with message [{message}]")
-                await self.client.send_file(chat, file_path, caption=message)
-                self.logging.info(f"sendBigDocument - File sent [{file_path}]")
-                await self.client.delete_messages(chat, msg1)
-                self.logging.debug("sendBigDocument - Deleted previous message")
-            except Exception as e:
-                self.logging.error(f"Error during file sending with Telethon: {e}")
-                # Fallback a send_small_document se necessario
-                await self.send_small_document(file_path, message, chat)
-                # Logout e pulizia
-                await self.client.log_out()
-                delattr(self, 'client')
+            fingerprint = await asyncio.to_thread(file_fingerprint, file_path)
+            file_id = self.db.getFileId(fingerprint, kind)
+            if file_id:
+                try:
+                    # The parts of a split file are stored as a single space separated list
+                    documents = [unpack_document(reference) for reference in file_id.split()]
+                    if split:
+                        await self.send_parts(client, chat, documents, message)
+                    else:
+                        await client.send_file(chat, documents[0], caption=message, force_document=True)
+                    self.logging.info(f"sendBigDocument - File sent by reference [{file_path}]")
+                    return True
+                except Exception as err:
+                    self.logging.warning(f"sendBigDocument - Stored file id refused [{err}] - Uploading again")
+                    self.db.removeFileId(fingerprint, kind)
+            msg1 = await client.send_message(chat, 'Nuovo giornale in arrivo...')
+            self.logging.debug(f"Attempting sending [{file_path}] to chat [{chat}] with message [{message}]")
+            if split:
+                sent = await self.send_split_document(client, chat, file_path, fingerprint, message)
+            elif size >= BIG_FILE_MIN_SIZE:
+                sent = await self.send_resumable_document(client, chat, file_path, fingerprint, message)
+            else:
+                sent = await client.send_file(chat, await client.upload_file(file_path), caption=message,
+                                              force_document=True)
+            self.logging.info(f"sendBigDocument - File sent [{file_path}]")
+            documents = [m.document for m in sent] if split else [sent.document]
+            if all(documents):
+                self.db.storeFileId(fingerprint, kind, " ".join(pack_document(d) for d in documents))
+            await client.delete_messages(chat, msg1)
+            self.logging.debug("sendBigDocument - Deleted previous message")
+            return True
         except Exception as e:
-            self.logging.error(f"Overall error in send_big_document: {e}")
+            self.logging.error(f"Error during file sending with Telethon: {e}")
+            # Check the session before the next upload, without discarding it
+            self.clientCheckedAt = 0
+            if size >= self.uploadScheduler.maxSmallSize:
+                # The bot cannot send it either - Let the caller retry later
+                return False
             # Fallback a send_small_document
             self.logging.info("Falling back to send_small_document")
-            await self.send_small_document(file_path, message, chat)
+            return await self.send_small_document(file_path, message, chat)
+
+    async def upload_resumable(self, uploader, file_path, key, offset=0, length=None, name=None, restart=False):
+        """
+        Upload a big file, or a byte range of it, resuming the parts already acknowledged by Telegram
+        :param uploader: The ParallelUploader to use
+        :param file_path: The file to upload
+        :param key: The key the upload progress is stored with
+        :param offset: The first byte to upload
+        :param length: The number of bytes to upload (until the end of the file if None)
+        :param name: The file name shown on Telegram
+        :param restart: Discard the stored progress and upload every part again
+        :return: The uploaded InputFileBig
+        """
+        if length is None:
+            length = os.path.getsize(file_path) - offset
+        total_parts = uploader.count_parts(length)
+        upload = None if restart else self.db.getUpload(key)
+        if upload and upload[1] == uploader.partSize and upload[2] == total_parts:
+            file_id, done_parts = upload[0], upload[3]
+            self.logging.info(f"upload_resumable - Resuming [{name or file_path}] from {len(done_parts)}/{total_parts} parts")
+        else:
+            file_id, done_parts = ParallelUploader.new_file_id(), set()
+            self.db.startUpload(key, file_id, uploader.partSize, total_parts)
+        acknowledged = []
+
+        def on_part(part):
+            acknowledged.append(part)
+            if len(acknowledged) >= UPLOAD_PART_BATCH:
+                self.db.storeUploadParts(key, acknowledged)
+                acknowledged.clear()
+
+        try:
+            return await uploader.upload(
+                file_path,
+                offset,
+                length,
+                name=name,
+                file_id=file_id,
+                done_parts=done_parts,
+                on_part=on_part
+            )
+        finally:
+            # Also keep the progress of a failed upload, to resume it
+            if acknowledged:
+                self.db.storeUploadParts(key, acknowledged)
+
+    async def upload_with_resume(self, client, file_path, ranges, send):
+        """
+        Upload byte ranges of a file as Telegram files, resuming the parts already acknowledged, then send them.
+        Telegram discards the uploaded parts after a while: if they are refused, the upload restarts from scratch once
+        :param client: The connected Telegram client
+        :param file_path: The file to upload
+        :param ranges: The list of (progress key, offset, length, name) of the Telegram files to upload
+        :param send: Coroutine function sending the list of uploaded files
+        :return: What send returns
+        """
+        uploader = ParallelUploader(client, self.logging, self.localParameters['Telegram']['uploadPartsInFlight'])
+        for attempt in range(2):
+            uploaded = []
+            for key, offset, length, name in ranges:
+                uploaded.append(await self.upload_resumable(uploader, file_path, key, offset, length, name,
+                                                            restart=attempt > 0))
+            try:
+                sent = await send(uploaded)
+            except telethon.errors.RPCError as err:
+                if attempt or 'FILE_PART' not in str(getattr(err, 'message', err)).upper():
+                    raise
+                self.logging.warning(
+                    f"upload_with_resume - Uploaded parts of [{file_path}] expired [{err}] - Restarting upload")
+                continue
+            for key, offset, length, name in ranges:
+                self.db.removeUpload(key)
+            return sent
+
+    async def send_resumable_document(self, client, chat, file_path, fingerprint, message):
+        """
+        Upload a big file resuming the parts already acknowledged by Telegram, then send it
+        :param client: The connected Telegram client
+        :param chat: The chat the file will be sent to
+        :param file_path: The file to send
+        :param fingerprint: The file content fingerprint
+        :param message: The message to send with the file
+        :return: The sent message
+        """
+        return await self.upload_with_resume(
+            client,
+            file_path,
+            [(fingerprint, 0, None, None)],
+            lambda uploaded: client.send_file(chat, uploaded[0], caption=message, force_document=True)
+        )
+
+    async def send_split_document(self, client, chat, file_path, fingerprint, message):
+        """
+        Send a file too big for a single upload as numbered parts (name.001, name.002, ...) grouped in albums.
+        Each part is uploaded straight from its byte range of the file, without copying it
+        :param client: The connected Telegram client
+        :param chat: The chat the file will be sent to
+        :param file_path: The file to send
+        :param fingerprint: The file content fingerprint
+        :param message: The message to send with the file, shown on the first part
+        :return: The list of sent messages, one for each part
+        """
+        size = os.path.getsize(file_path)
+        # Parts of the same size (give or take a byte), so that none of them is left too small for a big upload
+        count = math.ceil(size / self.splitSize)
+        base, extra = divmod(size, count)
+        digits = max(3, len(str(count)))
+        ranges = []
+        offset = 0
+        for index in range(count):
+            length = base + (index < extra)
+            # Each part keeps its own upload progress, not reused if the parts change with the split size
+            ranges.append((f"{fingerprint}:{offset}:{length}", offset, length,
+                           f"{os.path.basename(file_path)}.{index + 1:0{digits}d}"))
+            offset += length
+        self.logging.info(f"send_split_document - Splitting [{file_path}] in {count} parts")
+        return await self.upload_with_resume(
+            client,
+            file_path,
+            ranges,
+            lambda uploaded: self.send_parts(client, chat, uploaded, message)
+        )
+
+    async def send_parts(self, client, chat, files, message):
+        """
+        Send the parts of a split file as a single album - Albums hold up to ALBUM_SIZE files,
+        so the parts after those are sent as further albums replying to the first one
+        :param client: The connected Telegram client
+        :param chat: The chat the parts will be sent to
+        :param files: The uploaded parts, or the references of the parts already sent
+        :param message: The message to send with the parts, shown on the first one
+        :return: The list of sent messages, one for each part
+        """
+        sent = await client.send_file(chat, files[:ALBUM_SIZE], caption=message, force_document=True)
+        for start in range(ALBUM_SIZE, len(files), ALBUM_SIZE):
+            sent += await client.send_file(chat, files[start:start + ALBUM_SIZE], force_document=True,
+                                           reply_to=sent[0].id)
+        return sent
 
     def get_chat_parsed(self, chat_id):
         """
@@ -376,22 +719,33 @@ class Giornalettiere:
         """
         print('Uploaded', current, 'out of', total, 'bytes: {:.2%}'.format(current / total))
 
-    async def connect_to_telegram_client(self, session_name):
-        """
-        Connect to telegram client
-        :param session_name: The session name used to connect
-        :return: None
-        """
-        if not hasattr(self, 'client'):
-            self.client = TelegramClient(session_name, self.localParameters['Telegram']['apiId'],
-                                         self.localParameters['Telegram']['apiHash'])
-            self.logging.info("Created client instance")
-            await self.client.start(bot_token=self.localParameters['Telegram']['telegram_token'])
-            self.logging.info("Client restarted")
-        else:
+    async def get_telegram_client(self):
+        """
+        Return the long-lived Telegram client, creating it the first time and
+        checking periodically that its session is still working
+        :return: A connected TelegramClient
+        """
+        async with self.clientLock:
+            if self.client is None:
+                session_file = create_absolute_path(os.path.join(self.settingDir, 'bot_session.session'))
+                self.client = TelegramClient(session_file, self.localParameters['Telegram']['apiId'],
+                                             self.localParameters['Telegram']['apiHash'])
+                self.logging.info("Created client instance")
+                await self.client.start(bot_token=self.localParameters['Telegram']['telegram_token'])
+                self.clientCheckedAt = time.monotonic()
+                self.logging.info("Client started")
             if not self.client.is_connected():
                 self.logging.info("Connecting client")
                 await self.client.connect()
+            if time.monotonic() - self.clientCheckedAt > CLIENT_HEALTH_CHECK_INTERVAL:
+                try:
+                    await asyncio.wait_for(self.client.get_me(), CLIENT_HEALTH_CHECK_TIMEOUT)
+                except Exception as err:
+                    self.logging.warning(f"get_telegram_client - Health check failed [{err}] - Reconnecting client")
+                    await self.client.disconnect()
+                    await self.client.connect()
+                self.clientCheckedAt = time.monotonic()
+            return self.client
 
     def create_handlers(self):
         """
@@ -401,6 +755,12 @@ class Giornalettiere:
         # Commands
         self.application.add_handler(CommandHandler("update", self.update_handler))
         self.application.add_handler(CommandHandler("news", self.news_handler))
+        # Admin commands
+        admins = filters.User(user_id=self.localParameters['Telegram']['admins'])
+        self.application.add_handler(CommandHandler("trace", self.trace_handler, filters=admins))
+        self.application.add_handler(CommandHandler("queue", self.queue_handler, filters=admins))
+        # The profile lasts several seconds, the other updates are handled meanwhile
+        self.application.add_handler(CommandHandler("profile", self.profile_handler, filters=admins, block=False))
         self.logging.info("createHandlers - Created handlers for command")
         # Text message
         # self.application.add_handler(MessageHandler(filters.TEXT, self.text_handler))
@@ -452,59 +812,110 @@ class Giornalettiere:
 
     def request_download(self, links):
         """
-        Send requested link to a download service
+        Queue the requested links for the download service - Returns immediately
         :param links: The list of links to download
         :return: None
         """
         if isinstance(links, list):
-            links_text = "\n".join(links)
+            files = links
         elif isinstance(links, str):
-            links_text = links
+            files = links.splitlines()
         else:
-            self.logging.warning("request_download - Expected list or string - Reveived: " + type(links))
-            links_text = ""
+            self.logging.warning("request_download - Expected list or string - Reveived: " + str(type(links)))
+            files = []
+        files = [f for f in files if f]
+        if files:
+            self.logging.info("request_download - Queued " + str(len(files)) + " files [" + ", ".join(files) + "]")
+            self.downloadSubmitter.submit(files)
 
-        payload = {'titolo': self.localParameters['Download']['downloadRequest'], 'link': links_text}
-        self.logging.info(
-            "request_download - Request download to my site [" + self.localParameters['Download']['downloadSite'] + "]")
-        requests.post(self.localParameters['Download']['downloadSite'], data=payload)
-        files = links_text.splitlines()
-        self.logging.info(
-            "request_download - Request download of " + str(len(files)) + " files [" + ", ".join(files) + "]")
+    async def fetch_data_async(self):
+        """
+        Run fetch_data in a worker thread, without blocking the event loop
+        :return: The list of links requested
+        """
+        return await asyncio.to_thread(self.fetch_data)
 
     # Retrieve data to upload on Telegram
     def fetch_data(self):
-        result = []
+        """
+        Run all the download configurations in parallel and request the download of the links found
+        :return: The list of links requested
+        """
         # Get data
         self.logging.info("fetch_data - Fetching new documents")
         print("fetch_data - Fetching new documents")
-        downloadConfigDir = "DownloadConfig"
-        downloadConfigFiles = os.listdir(downloadConfigDir)
-        for filename in downloadConfigFiles:
-            if filename.endswith(".toml"):
-                with open(os.path.join(downloadConfigDir, filename), "rb") as f:
-                    downloadConfig = tomllib.load(f)
-                gd = GiornalettiereDownloader(self.logging, downloadConfig)
-                output = gd.extractRelevantLinks()
-                # Decode json result
-                if not output:
-                    self.logging.warning("fetch_data - Cannot fetch any data")
-                else:
-                    result = []
-                    for out in output:
-                        result.append(out['url'])
-                # Request download if any link is found
-                if len(result):
-                    self.request_download(result)
-                return result
-        if not downloadConfigFiles:
+        downloaders = self.downloadConfigs.get_downloaders()
+        if not downloaders:
             self.logging.warning("fetch_data - No download configuration files found - Skip any search")
             return []
 
+        result = []
+        timeout = self.localParameters['Download']['sourceTimeout']
+        workers = min(len(downloaders), self.localParameters['Download']['sourceWorkers'])
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="source")
+        # Each source is timed from its own start, so the sources queued behind the slow ones get their full time
+        started = {}
+
+        def run(filename, gd):
+            started[filename] = time.monotonic()
+            return self.fetch_source(filename, gd, timeout)
+
+        sources = {pool.submit(run, filename, gd): filename for filename, gd in downloaders}
+        # A source stalled in a request is not awaited past its timeout, and the whole search has an upper bound
+        limit = timeout + SOURCE_TIMEOUT_MARGIN
+        give_up_at = time.monotonic() + math.ceil(len(sources) / workers) * limit
+        pending = set(sources)
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=SOURCE_CHECK_INTERVAL, return_when=FIRST_COMPLETED)
+                for source in done:
+                    try:
+                        result.extend(source.result())
+                    except TimeoutError:
+                        SOURCE_FAILURES.labels(sources[source]).inc()
+                        self.logging.error(f"fetch_data - Source [{sources[source]}] still running after {timeout}s - Skipped")
+                    except Exception as err:
+                        SOURCE_FAILURES.labels(sources[source]).inc()
+                        self.logging.error(f"fetch_data - Source [{sources[source]}] failed [{err}]")
+                now = time.monotonic()
+                for source in list(pending):
+                    filename = sources[source]
+                    if now >= give_up_at or (filename in started and now - started[filename] > limit):
+                        pending.discard(source)
+                        SOURCE_FAILURES.labels(filename).inc()
+                        self.logging.error(f"fetch_data - Source [{filename}] did not finish - Skipped")
+        finally:
+            # The skipped sources are not awaited, their threads end with their requests
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        # Request download if any link is found
+        result = list(dict.fromkeys(result))
+        if len(result):
+            self.request_download(result)
+        return result
+
+    def fetch_source(self, filename, gd, timeout=None):
+        """
+        Search the relevant links of a single download configuration
+        :param filename: The download configuration file name
+        :param gd: The GiornalettiereDownloader of the configuration
+        :param timeout: Seconds the search can last, from its start
+        :return: The list of links found
+        :raise TimeoutError: If the search lasts longer than the timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with SOURCE_SECONDS.labels(filename).time():
+            output = gd.extractRelevantLinks(deadline)
+        # Decode json result
+        if not output:
+            self.logging.warning(f"fetch_data - Cannot fetch any data from [{filename}]")
+            return []
+        return [out['url'] for out in output]
+
     # Search for new file to download
     async def update_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         self.logging.info("update_handler - Bot started by: " + str(update.effective_chat))
-        result = self.fetch_data()
+        result = await self.fetch_data_async()
         if len(result):
             await update.message.reply_text(
                 "Ciao " + str(update.effective_chat.first_name) + " 👋, sto prelevando dei nuovi file 🛒")
@@ -527,3 +938,74 @@ class Giornalettiere:
         )
 
         await self.update_channel()
+
+    async def trace_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Handles the /trace [on|off] admin command, turning the handlers latency tracing on and off
+        :param update: The reference to message update
+        :param context: The command arguments
+        :return: None
+        """
+        action = context.args[0].lower() if context.args else "status"
+        self.logging.info(f"trace_handler - Trace [{action}] requested by [{update.effective_user.id}]")
+        if action == "on":
+            self.tracer.enable(self.application, self, TRACED_METHODS)
+            await update.message.reply_text("Tracing enabled")
+        elif action == "off":
+            summary = self.tracer.summary()
+            self.tracer.disable()
+            await update.message.reply_text("\n".join(["Tracing disabled"] + summary)[:4095])
+        else:
+            status = "enabled" if self.tracer.enabled else "disabled"
+            await update.message.reply_text("\n".join([f"Tracing {status}"] + self.tracer.summary())[:4095])
+
+    async def profile_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Handles the /profile [seconds] admin command, sampling the process for the given time
+        :param update: The reference to message update
+        :param context: The command arguments
+        :return: None
+        """
+        max_seconds = self.localParameters['Profiling']['maxProfileSeconds']
+        try:
+            seconds = min(max(1, int(context.args[0])), max_seconds) if context.args else 30
+        except ValueError:
+            await update.message.reply_text(f"Usage: /profile [seconds, at most {max_seconds}]")
+            return
+        self.logging.info(f"profile_handler - Profile of {seconds}s requested by [{update.effective_user.id}]")
+        if self.profiler.running:
+            await update.message.reply_text("A profile is already running")
+            return
+        await update.message.reply_text(f"Profiling for {seconds}s...")
+        path, samples = await self.run_profile(seconds)
+        if samples is None:
+            await update.message.reply_text("A profile is already running")
+        else:
+            await update.message.reply_text(f"Profile written to {path} ({samples} samples)")
+
+    async def run_profile(self, seconds):
+        """
+        Profile the process without blocking the event loop
+        :param seconds: Seconds to profile
+        :return: The tuple (folded stacks file, number of samples - None if another profile is running)
+        """
+        path = create_absolute_path(os.path.join(
+            self.settingDir, "profile-" + datetime.now().strftime("%Y%m%d-%H%M%S") + ".folded"))
+        samples = await asyncio.to_thread(self.profiler.run, seconds, path)
+        return path, samples
+
+    async def queue_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Handles the /queue [retry] admin command, showing the upload backlog and the files given up
+        :param update: The reference to message update
+        :param context: The command arguments
+        :return: None
+        """
+        lines = []
+        if context.args and context.args[0].lower() == "retry":
+            lines.append(f"Queued again {self.uploadQueue.retry_failed()} failed files")
+        backlog = self.uploadQueue.backlog()
+        lines.append(", ".join(f"{state}: {count}" for state, count in backlog.items()))
+        for file_name, attempts, error in self.db.getFailedJobs(10):
+            lines.append(f"{file_name} - {attempts} attempts [{error}]")
+        await update.message.reply_text("\n".join(lines)[:4095])
@@ -1,18 +1,42 @@
 import requests
-from bs4 import BeautifulSoup
+from ExtractionPlan import ExtractionPlan
+from HttpClient import HttpClient
+from KeywordMatcher import KeywordMatcher, ShortestMatchSelector
+from Metrics import REGISTRY
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import date
-import re
+from urllib.parse import urlparse
+import threading
+import time
+
+SCRAPE_PAGE_SECONDS = REGISTRY.histogram("giornalettiere_scrape_page_seconds", "Time spent downloading and parsing each page",
+                                         ["source", "page"])
+SCRAPE_LINKS = REGISTRY.counter("giornalettiere_scrape_links_total", "Download links found in the posts", ["source"])
 
 
 class GiornalettiereDownloader:
 
-    def __init__(self, loggingHandler, downloadConfig):
+    def __init__(self, loggingHandler, downloadConfig, cacheDir=None):
         self.logging = loggingHandler
         self.name = downloadConfig['name']
+        self.http = HttpClient(loggingHandler, cacheDir, downloadConfig.get('timeout', (5, 30)),
+                               cache_max_age=downloadConfig.get('cache_days', 30) * 86400)
         self.urls = self.compose_urls(downloadConfig['domains'], downloadConfig["query"])
         self.listConfig = downloadConfig["List"]
         self.downloadConfig = downloadConfig["Download"]
         self.relevantContent = downloadConfig['relevantContent']
+        self.keywordMatcher = KeywordMatcher(self.relevantContent)
+        # The extraction steps are compiled once for all the pages
+        self.listPlan = ExtractionPlan(self.listConfig, loggingHandler, self.name)
+        self.downloadPlan = ExtractionPlan(self.downloadConfig, loggingHandler, self.name)
+        self.hosts = [str(host).lower() for host in self.downloadConfig["host"]]
+        crawlConfig = downloadConfig.get("Crawl", {})
+        self.crawlWorkers = max(1, int(crawlConfig.get("workers", 4)))
+        self.crawlPerDomain = max(1, int(crawlConfig.get("per_domain", 2)))
+        self.crawlDelay = float(crawlConfig.get("delay", 0.5))
+        self.domainLock = threading.Lock()
+        self.domainSlots = {}
+        self.domainNextRequest = {}
 
     def compose_urls(self, domains, query):
         """Creates the urls"""
@@ -21,61 +45,96 @@ class GiornalettiereDownloader:
             urls.append("{}{}".format(domain, query))
         return urls
 
-    def extractRelevantLinks(self):
-        """Extracts the relevant links"""
-        regex = re.compile('[^a-zA-Z0-9]')
-        myLink = {}
-        for key in self.relevantContent:
-            myLink[key] = []
+    @staticmethod
+    def remaining(deadline):
+        """Seconds left before the deadline (a time.monotonic value), None if there is no deadline"""
+        return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+    def extractRelevantLinks(self, deadline=None):
+        """Extracts the relevant links - Raises TimeoutError if the search is still running at the deadline"""
+        selector = ShortestMatchSelector(self.keywordMatcher)
 
-        # Extract a valid url
-        url = self.getUrl()
+        # Extract a valid url, with the posts already found on it
+        url, posts = self.getUrl(deadline)
         if not url:
             self.logging.error("No url found")
             return []
 
-        for info in self.extractPostList(url):
-            self.logging.info(f"extractRelevantLinks - Extracting download links from: {info['title']} [{info['url']}]")
-            for link in self.extractAllDownloadLinks(info['url']):
+        for info, links in self.crawlPosts(posts, deadline):
+            self.logging.info(f"extractRelevantLinks - Extracted download links from: {info['title']} [{info['url']}]")
+            for link in links:
                 try:
-                    for key in self.relevantContent:
-                        cleanKey = regex.sub('', key).lower()
-                        cleanTitle = regex.sub('', link['title']).lower()
-                        if cleanKey in cleanTitle:
-                            myLink[key].append(link)
-                            self.logging.info(f"{self.name} - extractRelevantLinks - Found: {link['title']} [{link['url']}]")
-                except AttributeError:
+                    if selector.add(link):
+                        self.logging.info(f"{self.name} - extractRelevantLinks - Found: {link['title']} [{link['url']}]")
+                except (AttributeError, TypeError):
                     self.logging.info(f"{self.name} - extractRelevantLinks - Cannot find any download link in {link}")
-        results = []
-        for key in list(myLink.keys()):
-            # More than 1 result obtained - Get shortest
-            if len(myLink[key]) > 1:
-                shortest = myLink[key][0]
-                for x in myLink[key]:
-                    if len(x['title']) < len(shortest):
-                        shortest = x
-                results.append(shortest)
-            # Get the only result
-            elif len(myLink[key]) == 1:
-                results.append(myLink[key][0])
-            # Notify a possible problem
-            else:
-                self.logging.error(f"{self.name} - extractRelevantLinks - No result found for key {key}")
-        return results
+        # Notify a possible problem
+        for key in selector.missing():
+            self.logging.error(f"{self.name} - extractRelevantLinks - No result found for key {key}")
+        return selector.results()
+
+    def crawlPosts(self, posts, deadline=None):
+        """Visits the posts concurrently, yielding their download links as soon as each page is parsed"""
+        pool = ThreadPoolExecutor(max_workers=self.crawlWorkers, thread_name_prefix="crawl")
+        try:
+            visits = {pool.submit(self.visitPost, info['url'], deadline): info for info in posts}
+            for visit in as_completed(visits, timeout=self.remaining(deadline)):
+                info = visits[visit]
+                try:
+                    yield info, visit.result()
+                except TimeoutError:
+                    raise
+                except Exception as e:
+                    self.logging.warning(f"{self.name} - crawlPosts - Cannot visit {info['url']}: {str(e)}")
+        finally:
+            # Past the deadline the queued visits are dropped, the running ones end within the request timeout
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def visitPost(self, url, deadline=None):
+        """Extracts the download links of a post, respecting the per-domain limits"""
+        domain = urlparse(url).netloc
+        with self.domainLock:
+            slots = self.domainSlots.setdefault(domain, threading.BoundedSemaphore(self.crawlPerDomain))
+        with slots:
+            # Politeness - Requests to the same domain start at least crawlDelay seconds apart
+            with self.domainLock:
+                now = time.monotonic()
+                start = max(now, self.domainNextRequest.get(domain, now))
+                self.domainNextRequest[domain] = start + self.crawlDelay
+            if start > now:
+                time.sleep(start - now)
+            if self.remaining(deadline) == 0:
+                raise TimeoutError(f"Deadline reached before visiting {url}")
+            with SCRAPE_PAGE_SECONDS.labels(self.name, "post").time():
+                links = list(self.extractAllDownloadLinks(url))
+            SCRAPE_LINKS.labels(self.name).inc(len(links))
+            return links
 
     def validUrl(self, url):
-        """Check if the site has something useful"""
+        """Check if the site has something useful, returning the relevant posts found"""
         try:
-            return len(list(self.extractPostList(url)))
+            with SCRAPE_PAGE_SECONDS.labels(self.name, "list").time():
+                return list(self.extractPostList(url))
         except Exception as e:
             self.logging.info(f"{self.name} - validUrl - Error: {str(e)}")
-            return False
+            return []
 
-    def getUrl(self):
-        for url in self.urls:
-            if self.validUrl(url):
-                return url
-        return None
+    def getUrl(self, deadline=None):
+        """Probes all the domains concurrently, the first one with relevant posts wins"""
+        if not self.urls:
+            return None, []
+        pool = ThreadPoolExecutor(max_workers=len(self.urls), thread_name_prefix="probe")
+        try:
+            probes = {pool.submit(self.validUrl, url): url for url in self.urls}
+            for probe in as_completed(probes, timeout=self.remaining(deadline)):
+                posts = probe.result()
+                if posts:
+                    self.logging.info(f"{self.name} - getUrl - Using {probes[probe]}")
+                    return probes[probe], posts
+            return None, []
+        finally:
+            # Slower mirrors are not awaited, their requests end within the configured timeout
+            pool.shutdown(wait=False, cancel_futures=True)
 
     def extractPostList(self, url):
         if self.listConfig.get('relevant_date') == "today":
@@ -84,10 +143,12 @@ class GiornalettiereDownloader:
             self.logging.warning(f"{self.name} - extractPostList - Relevant date not yet supported")
             reference_date = date.today().strftime("%d.%m.%Y")
         try:
-            page = requests.get(url)
-            start_soup = BeautifulSoup(page.content, 'html.parser')
-            mainSection = self.executeSearchSteps(start_soup, self.listConfig.get("search_steps", []))
-            posts = self.extractInfo(mainSection, self.listConfig.get("search_element"))
+            if self.listConfig.get("streaming", False):
+                with self.http.stream(url) as (chunks, charset):
+                    posts = self.listPlan.extract_stream(chunks, charset)
+            else:
+                page = self.http.get(url)
+                posts = self.listPlan.extract(page.content)
         except AttributeError:
             self.logging.warning(f"{self.name} - extractPostList - Cannot find any posts in {url}")
             posts = []
@@ -98,66 +159,14 @@ class GiornalettiereDownloader:
             if reference_date in post[self.listConfig.get("key_containing_date", "title")]:
                 yield post
 
-    def executeSearchSteps(self, soup, search_steps):
-        """Execute the search steps to reach the section with relevant information"""
-        for search_step in search_steps:
-            attributes = self.elaboratesAttributes(search_step)
-            html_type = search_step.get('type', None)
-            soup = soup.find(name=html_type, attrs=attributes)
-        return soup
-
-    def elaboratesAttributes(self, search_step):
-        """Elabelates the attributes for beautifulsoup"""
-        attr = {}
-        attribute = search_step.get('attribute', None)
-        name = search_step.get('name', None)
-        if attribute == "class" and name:
-            attr['class'] = name
-        elif attribute == "id" and name:
-            attr['id'] = name
-        else:
-            self.logging.debug(f"{self.name} - elaboratesAttributes - No attributes requested")
-        return attr
-
-    def extractInfo(self, mainSection, search_element):
-        info = []
-        elements_attribute = search_element.get('element', None)
-        if elements_attribute is None:
-            self.logging.warning("extractInfo - Missing search element")
-        else:
-            # Iterates over the given search element
-            attributes = self.elaboratesAttributes(elements_attribute)
-            html_type = elements_attribute.get('type', None)
-            extractions = search_element.get('extract', [])
-            for html_element in mainSection.find_all(name=html_type, attrs=attributes):
-                info_element = {}
-                for extraction_info in extractions:
-                    info_element[extraction_info["key"]] = self.extractData(html_element, extraction_info)
-                if info_element:
-                    info.append(info_element)
-        return info
-
-    def extractData(self, html_element, extraction_info):
-        searched_value = extraction_info.get('value')
-        further_steps = extraction_info.get("steps", [])
-        soup = self.executeSearchSteps(html_element, further_steps)
-        if not soup:
-            self.logging.warning(f"extractData - Cannot execute the following steps: {str(further_steps)}")
-            return None
-        if searched_value == "href":
-            return soup["href"]
-        elif searched_value == "text":
-            return soup.text
-        else:
-            self.logging.warning(f"{self.name} - extractData - Invalid value to extract [{searched_value}]")
-            return None
-
     def extractAllDownloadLinks(self, url):
-        page = requests.get(url)
-        start_soup = BeautifulSoup(page.content, 'html.parser', from_encoding=self.downloadConfig["page_encoding"])
-        mainSection = self.executeSearchSteps(start_soup, self.downloadConfig.get("search_steps", []))
-        links = self.extractInfo(mainSection, self.downloadConfig.get("search_element"))
+        if self.downloadConfig.get("streaming", False):
+            with self.http.stream(url) as (chunks, charset):
+                links = self.downloadPlan.extract_stream(chunks, self.downloadConfig["page_encoding"] or charset)
+        else:
+            page = self.http.get(url)
+            links = self.downloadPlan.extract(page.content, self.downloadConfig["page_encoding"])
         for link in links:
-            for host in self.downloadConfig["host"]:
-                if str(host).lower() in str(link).lower():
+            for host in self.hosts:
+                if host in str(link).lower():
                     yield link
\ No newline at end of file
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from Metrics import REGISTRY
+
+HTTP_SECONDS = REGISTRY.histogram("giornalettiere_http_request_seconds", "Time spent downloading each page", ["mode"])
+HTTP_RESPONSES = REGISTRY.counter("giornalettiere_http_responses_total", "Pages requested, by status code", ["status"])
+HTTP_CACHE_HITS = REGISTRY.counter("giornalettiere_http_cache_hits_total", "Pages not modified, taken from the cache")
+HTTP_CACHE_PRUNED = REGISTRY.counter("giornalettiere_http_cache_pruned_total", "Cached pages removed after being unused too long")
+
+# Minimum seconds between two prunings of the cache directory
+PRUNE_INTERVAL = 3600
+
+
+class HttpResponse:
+    """
+    The content of a page, either downloaded or taken from the cache
+    """
+
+    def __init__(self, url, status_code, content, from_cache=False):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.from_cache = from_cache
+
+
+class HttpClient:
+    """
+    A pooled HTTP client with timeouts and keep-alive.
+    When a cache directory is given, pages are stored on disk with their ETag/Last-Modified
+    and later requests for the same url are conditional, so unchanged pages cost a 304.
+    Cached pages unused for longer than the maximum age are pruned while new pages are stored
+    """
+
+    def __init__(self, logging_handler, cache_dir=None, timeout=(5, 30), pool_size=8, retries=2,
+                 cache_max_age=30 * 86400):
+        """
+        Create the client
+        :param logging_handler: A logging instance
+        :param cache_dir: The directory used to store the pages - No cache if None
+        :param timeout: The (connect, read) timeout in seconds
+        :param pool_size: Maximum number of connections kept alive for each host
+        :param retries: Retries on connection errors and on 502/503/504 responses
+        :param cache_max_age: Seconds a cached page is kept without being used
+        """
+        self.logging = logging_handler
+        self.cacheDir = cache_dir
+        self.cacheMaxAge = cache_max_age
+        self.lastPruned = 0
+        self.timeout = tuple(timeout) if isinstance(timeout, (list, tuple)) else timeout
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=[502, 503, 504], allowed_methods=["GET"])
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if self.cacheDir:
+            os.makedirs(self.cacheDir, exist_ok=True)
+
+    def get(self, url):
+        """
+        Download a page, revalidating the cached copy if available
+        :param url: The url to download
+        :return: The HttpResponse
+        """
+        meta = self.read_cache_meta(url)
+        headers = {}
+        if meta:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        with HTTP_SECONDS.labels("get").time():
+            page = self.session.get(url, headers=headers, timeout=self.timeout)
+        HTTP_RESPONSES.labels(page.status_code).inc()
+        if page.status_code == 304 and meta:
+            content = self.read_cache_body(url)
+            if content is not None:
+                self.logging.debug(f"HttpClient - Not modified [{url}]")
+                HTTP_CACHE_HITS.inc()
+                return HttpResponse(url, 200, content, from_cache=True)
+            # The cached body is lost - Download the page again
+            with HTTP_SECONDS.labels("get").time():
+                page = self.session.get(url, timeout=self.timeout)
+            HTTP_RESPONSES.labels(page.status_code).inc()
+        if page.status_code == 200:
+            self.write_cache(url, page)
+        return HttpResponse(url, page.status_code, page.content)
+
+    @contextmanager
+    def stream(self, url, chunk_size=16384):
+        """
+        Download a page incrementally, bypassing the cache.
+        Leaving the context before the end closes the connection, without reading the rest of the body
+        :param url: The url to download
+        :param chunk_size: The size of each chunk in bytes
+        :return: A context manager yielding the tuple (iterator over the content chunks, charset declared by the server)
+        """
+        started = time.perf_counter()
+        page = self.session.get(url, stream=True, timeout=self.timeout)
+        HTTP_RESPONSES.labels(page.status_code).inc()
+        try:
+            charset = re.search(r'charset=["\']?([\w.:-]+)', page.headers.get("Content-Type", ""))
+            yield page.iter_content(chunk_size), charset.group(1) if charset else None
+        finally:
+            page.close()
+            HTTP_SECONDS.labels("stream").observe(time.perf_counter() - started)
+
+    def close(self):
+        """
+        Close all the pooled connections
+        :return: None
+        """
+        self.session.close()
+
+    def cache_path(self, url):
+        """
+        The base path of the cached copy of an url
+        :param url: The cached url
+        :return: The path without extension
+        """
+        return os.path.join(self.cacheDir, hashlib.sha256(url.encode()).hexdigest())
+
+    def read_cache_meta(self, url):
+        """
+        Read the validators of a cached page
+        :param url: The cached url
+        :return: The validators, None if the page is not cached
+        """
+        if not self.cacheDir:
+            return None
+        try:
+            with open(self.cache_path(url) + ".json") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def read_cache_body(self, url):
+        """
+        Read the content of a cached page
+        :param url: The cached url
+        :return: The page content, None if missing
+        """
+        path = self.cache_path(url) + ".body"
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            # The modification time marks the last use, checked by prune_cache
+            os.utime(path)
+            return content
+        except OSError:
+            return None
+
+    def write_cache(self, url, page):
+        """
+        Store a downloaded page if it has any validator
+        :param url: The downloaded url
+        :param page: The requests response
+        :return: None
+        """
+        if not self.cacheDir:
+            return
+        meta = {
+            "url": url,
+            "etag": page.headers.get("ETag"),
+            "last_modified": page.headers.get("Last-Modified"),
+        }
+        if not meta["etag"] and not meta["last_modified"]:
+            return
+        base = self.cache_path(url)
+        try:
+            # The old validators are dropped first, so they never describe a different body
+            if os.path.exists(base + ".json"):
+                os.remove(base + ".json")
+            with open(base + ".body.tmp", "wb") as f:
+                f.write(page.content)
+            os.replace(base + ".body.tmp", base + ".body")
+            with open(base + ".json.tmp", "w") as f:
+                json.dump(meta, f)
+            os.replace(base + ".json.tmp", base + ".json")
+        except OSError as err:
+            self.logging.warning(f"HttpClient - Cannot cache [{url}] [{err}]")
+        if time.monotonic() - self.lastPruned > PRUNE_INTERVAL:
+            self.lastPruned = time.monotonic()
+            self.prune_cache()
+
+    def prune_cache(self):
+        """
+        Remove the cached pages not used (downloaded or revalidated) for longer than the maximum age
+        :return: The number of pages removed
+        """
+        oldest = time.time() - self.cacheMaxAge
+        last_used = {}
+        try:
+            with os.scandir(self.cacheDir) as entries:
+                for entry in entries:
+                    base = entry.name.split(".", 1)[0]
+                    try:
+                        mtime = entry.stat().st_mtime
+                    except OSError:
+                        continue
+                    last_used[base] = max(last_used.get(base, 0), mtime)
+        except OSError as err:
+            self.logging.warning(f"HttpClient - Cannot prune the cache [{err}]")
+            return 0
+        expired = [base for base, mtime in last_used.items() if mtime < oldest]
+        for base in expired:
+            for extension in (".json", ".body", ".json.tmp", ".body.tmp"):
+                try:
+                    os.remove(os.path.join(self.cacheDir, base + extension))
+                except FileNotFoundError:
+                    pass
+                except OSError as err:
+                    self.logging.warning(f"HttpClient - Cannot remove [{base}{extension}] [{err}]")
+        if expired:
+            self.logging.info(f"HttpClient - Pruned {len(expired)} cached pages")
+            HTTP_CACHE_PRUNED.inc(len(expired))
+        return len(expired)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+import re
+from collections import deque
+
+NOT_ALPHANUMERIC = re.compile('[^a-zA-Z0-9]')
+
+
+def normalize(text):
+    """
+    Normalize a text for the comparison, keeping only lowercase letters and digits
+    :param text: The text to normalize
+    :return: The normalized text
+    """
+    return NOT_ALPHANUMERIC.sub('', text).lower()
+
+
+class KeywordMatcher:
+    """
+    Finds all the keywords contained in a text with a single pass (Aho-Corasick automaton).
+    Keywords and texts are compared after normalization
+    """
+
+    def __init__(self, keys):
+        """
+        Build the automaton
+        :param keys: The keywords to search
+        """
+        self.keys = list(dict.fromkeys(keys))
+        # Keys made only of symbols are contained in every text
+        self.always = set()
+        self.goto = [{}]
+        self.output = [set()]
+        for key in self.keys:
+            clean_key = normalize(key)
+            if not clean_key:
+                self.always.add(key)
+                continue
+            state = 0
+            for char in clean_key:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.output.append(set())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state].add(key)
+        self.fail = [0] * len(self.goto)
+        self.build_failure_links()
+
+    def build_failure_links(self):
+        """
+        Compute the failure links breadth first, merging the outputs of the suffixes
+        :return: None
+        """
+        # The states at depth 1 fail to the root
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] |= self.output[self.fail[child]]
+
+    def match(self, text):
+        """
+        Find the keywords contained in a text
+        :param text: The text to search
+        :return: The set of keywords found
+        """
+        found = set(self.always)
+        state = 0
+        for char in normalize(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.output[state]:
+                found |= self.output[state]
+        return found
+
+
+class ShortestMatchSelector:
+    """
+    Keeps, for each keyword, the matching link with the shortest title
+    """
+
+    def __init__(self, matcher):
+        """
+        Create the selector
+        :param matcher: The KeywordMatcher of the keywords
+        """
+        self.matcher = matcher
+        self.best = {}
+
+    def add(self, link):
+        """
+        Consider a new link
+        :param link: The link, with its title
+        :return: The keywords matched by the link title
+        """
+        keys = self.matcher.match(link['title'])
+        for key in keys:
+            current = self.best.get(key)
+            if current is None or len(link['title']) < len(current['title']):
+                self.best[key] = link
+        return keys
+
+    def missing(self):
+        """
+        :return: The keywords without any matching link
+        """
+        return [key for key in self.matcher.keys if key not in self.best]
+
+    def results(self):
+        """
+        :return: The selected links, in the keywords order
+        """
+        return [self.best[key] for key in self.matcher.keys if key in self.best]
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+import abc
+import bisect
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency buckets in seconds, from a single DB statement up to a big upload
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900)
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_value(value):
+    """
+    Format a sample value as Prometheus expects
+    :param value: The value
+    :return: The formatted value
+    """
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(labels):
+    """
+    Format a set of labels
+    :param labels: The list of (name, value)
+    :return: The formatted labels, empty if there are none
+    """
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+class Timer:
+    """
+    Context manager observing the time spent in its block
+    """
+
+    __slots__ = ("observe", "start")
+
+    def __init__(self, observe):
+        self.observe = observe
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.observe(time.perf_counter() - self.start)
+
+
+class CounterValue:
+    """
+    A value that can only grow
+    """
+
+    __slots__ = ("lock", "value")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [("", (), self.value)]
+
+
+class GaugeValue:
+    """
+    A value that can go up and down, or be read from a function when collected
+    """
+
+    __slots__ = ("lock", "value", "function")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+        self.function = None
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        """
+        Read the value from a function each time the metrics are collected
+        :param function: A function without arguments returning the value
+        :return: None
+        """
+        self.function = function
+
+    def samples(self):
+        return [("", (), self.function() if self.function else self.value)]
+
+
+class HistogramValue:
+    """
+    The distribution of the observed values over fixed buckets
+    """
+
+    __slots__ = ("lock", "buckets", "counts", "sum")
+
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        # The last count is for the values bigger than every bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """
+        :return: A context manager observing the time spent in its block
+        """
+        return Timer(self.observe)
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            samples.append(("_bucket", (("le", format_value(float(bound))),), cumulative))
+        samples.append(("_sum", (), total))
+        samples.append(("_count", (), cumulative))
+        return samples
+
+
+class Metric(abc.ABC):
+    """
+    A named metric, with a value for each combination of its labels - Subclasses define the kind of value
+    """
+
+    type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        Create the metric
+        :param name: The metric name
+        :param documentation: The metric description
+        :param labelnames: The names of the labels
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+        if not self.labelnames:
+            self.default = self.children[()] = self.new_value()
+
+    @abc.abstractmethod
+    def new_value(self):
+        """
+        :return: A new value of this kind of metric, for a combination of labels
+        """
+
+    def labels(self, *values):
+        """
+        The value of a combination of labels, created the first time
+        :param values: The label values, in the order of the label names
+        :return: The value
+        """
+        key = tuple(str(value) for value in values)
+        child = self.children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} - Expected labels {self.labelnames}, got {key}")
+            with self.lock:
+                child = self.children.setdefault(key, self.new_value())
+        return child
+
+    def render(self):
+        """
+        Render the metric in the Prometheus text format
+        :return: The list of lines
+        """
+        help_text = self.documentation.replace("\\", "\\\\").replace("\n", "\\n")
+        lines = [f"# HELP {self.name} {help_text}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            children = list(self.children.items())
+        for key, child in children:
+            labels = list(zip(self.labelnames, key))
+            for suffix, extra_labels, value in child.samples():
+                lines.append(f"{self.name}{suffix}{format_labels(labels + list(extra_labels))} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def new_value(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.default.inc(amount)
+
+
+class Gauge(Metric):
+    type = "gauge"
+    collector = None
+
+    def new_value(self):
+        return GaugeValue()
+
+    def inc(self, amount=1):
+        self.default.inc(amount)
+
+    def dec(self, amount=1):
+        self.default.dec(amount)
+
+    def set(self, value):
+        self.default.set(value)
+
+    def set_function(self, function):
+        self.default.set_function(function)
+
+    def set_collector(self, function):
+        """
+        Read the values of all the labels from a single function each time the metrics are collected
+        :param function: A function without arguments returning {tuple of label values: value}
+        :return: None
+        """
+        self.collector = function
+
+    def render(self):
+        if self.collector is not None:
+            for values, value in self.collector().items():
+                self.labels(*values).set(value)
+        return super().render()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(float(bound) for bound in buckets if bound != math.inf))
+        super().__init__(name, documentation, labelnames)
+
+    def new_value(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.default.observe(value)
+
+    def time(self):
+        return self.default.time()
+
+
+class MetricsRegistry:
+    """
+    The collection of all the metrics of the process
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        """
+        Add a metric, returning the one already registered with the same name if any
+        :param metric: The metric
+        :return: The registered metric
+        """
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is None:
+                self.metrics[metric.name] = metric
+                return metric
+        if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+            raise ValueError(f"Metric {metric.name} already registered with a different type or labels")
+        return existing
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """
+        Render all the metrics in the Prometheus text format
+        :return: The exposition text
+        """
+        with self.lock:
+            metrics = [self.metrics[name] for name in sorted(self.metrics)]
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# The registry shared by all the modules
+REGISTRY = MetricsRegistry()
+REGISTRY.gauge("giornalettiere_start_time_seconds", "Unix time when the process started").set(time.time())
+
+
+class MetricsServer:
+    """
+    Exposes a registry on /metrics, in the Prometheus text format
+    """
+
+    def __init__(self, registry, address, port, logging_handler):
+        """
+        Create the server
+        :param registry: The MetricsRegistry to expose
+        :param address: The address to listen on
+        :param port: The port to listen on - The server is disabled if 0
+        :param logging_handler: A logging instance
+        """
+        self.registry = registry
+        self.address = address
+        self.port = port
+        self.logging = logging_handler
+        self.server = None
+
+    def start(self):
+        """
+        Start serving from a daemon thread
+        :return: True if the server is running
+        """
+        if not self.port:
+            self.logging.info("MetricsServer - Disabled")
+            return False
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer((self.address, self.port), Handler)
+        except OSError as err:
+            self.logging.error(f"MetricsServer - Cannot listen on [{self.address}:{self.port}] [{err}]")
+            return False
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+        self.logging.info(f"MetricsServer - Serving metrics on [http://{self.address}:{self.port}/metrics]")
+        return True
+
+    def stop(self):
+        """
+        Stop the server
+        :return: None
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+import asyncio
+import math
+import os
+import random
+
+from telethon import errors
+from telethon.tl.functions.upload import SaveBigFilePartRequest
+from telethon.tl.types import InputFileBig
+
+from Metrics import REGISTRY
+
+# Biggest part accepted by upload.saveBigFilePart - https://core.telegram.org/api/files#uploading-files
+PART_SIZE = 512 * 1024
+
+# Files smaller than this must be uploaded with upload.saveFilePart
+BIG_FILE_MIN_SIZE = 10 * 1024 * 1024
+
+# Most parts of a single file accepted by upload.saveBigFilePart, which limits the file size to about 2GB
+MAX_PARTS = 4000
+MAX_FILE_SIZE = MAX_PARTS * PART_SIZE
+
+PART_SECONDS = REGISTRY.histogram("giornalettiere_upload_part_seconds", "Time spent sending each part of a big file",
+                                  buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+PART_BYTES = REGISTRY.counter("giornalettiere_upload_part_bytes_total", "Bytes of the big file parts acknowledged by Telegram")
+PART_RETRIES = REGISTRY.counter("giornalettiere_upload_part_retries_total", "Big file parts sent again, by reason", ["reason"])
+
+
+class ParallelUploader:
+    """
+    Uploads big files to Telegram keeping several parts in flight at the same time, instead of the single
+    part-after-part stream used by TelegramClient.upload_file.
+    All the parts share the single connection of the client: the gain comes from not waiting for each
+    acknowledgement before sending the next part, not from more sockets
+    """
+
+    def __init__(self, client, logging_handler, workers=4, part_size=PART_SIZE, retries=3):
+        """
+        Create the uploader
+        :param client: A connected TelegramClient
+        :param logging_handler: A logging instance
+        :param workers: Number of parts in flight at the same time
+        :param part_size: The size of each part in bytes
+        :param retries: Attempts made for each part before giving up
+        """
+        self.client = client
+        self.logging = logging_handler
+        self.workers = max(1, int(workers))
+        self.partSize = part_size
+        self.retries = retries
+
+    @staticmethod
+    def new_file_id():
+        """
+        Generate a new upload id
+        :return: A random 64 bit signed integer
+        """
+        return random.randrange(-2 ** 63, 2 ** 63)
+
+    def count_parts(self, length):
+        """
+        Count the parts needed to upload the given number of bytes
+        :param length: The number of bytes
+        :return: The number of parts
+        """
+        return max(1, math.ceil(length / self.partSize))
+
+    async def upload(self, file_path, offset=0, length=None, name=None, file_id=None, done_parts=(), on_part=None):
+        """
+        Upload a file, or a byte range of it, as a single Telegram file
+        :param file_path: The file to upload
+        :param offset: The first byte to upload
+        :param length: The number of bytes to upload (until the end of the file if None)
+        :param name: The file name shown on Telegram
+        :param file_id: The upload id - A new one is generated if None
+        :param done_parts: The parts already acknowledged by Telegram for this file id, they are not sent again
+        :param on_part: Optional function called with the index of each part acknowledged by Telegram
+        :return: The InputFileBig to use to send the uploaded file
+        """
+        if length is None:
+            length = os.path.getsize(file_path) - offset
+        if file_id is None:
+            file_id = self.new_file_id()
+        name = name or os.path.basename(file_path)
+        total_parts = self.count_parts(length)
+        queue = asyncio.Queue()
+        skipped = set(done_parts)
+        for part in range(total_parts):
+            if part not in skipped:
+                queue.put_nowait(part)
+        self.logging.info(f"ParallelUploader - Uploading [{name}] - {total_parts} parts, "
+                          f"{queue.qsize()} to send with {self.workers} workers")
+
+        fd = os.open(file_path, os.O_RDONLY)
+        reads = set()
+        workers = []
+
+        async def read(size, position):
+            # Shielded, so that a cancelled worker does not leave a thread reading the descriptor once it is closed
+            task = asyncio.ensure_future(asyncio.to_thread(os.pread, fd, size, position))
+            reads.add(task)
+            task.add_done_callback(reads.discard)
+            return await asyncio.shield(task)
+
+        async def worker():
+            while not queue.empty():
+                part = queue.get_nowait()
+                start = part * self.partSize
+                size = min(self.partSize, length - start)
+                data = await read(size, offset + start)
+                with PART_SECONDS.time():
+                    await self.send_part(file_id, part, total_parts, data)
+                PART_BYTES.inc(size)
+                if on_part:
+                    on_part(part)
+
+        try:
+            workers = [asyncio.ensure_future(worker()) for _ in range(min(self.workers, queue.qsize() or 1))]
+            await asyncio.gather(*workers)
+        finally:
+            # A failed part stops the other workers, and the file is closed only once nothing reads it
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if reads:
+                await asyncio.wait(reads)
+            os.close(fd)
+        return InputFileBig(id=file_id, parts=total_parts, name=name)
+
+    async def send_part(self, file_id, part, total_parts, data):
+        """
+        Send a single part, retrying on temporary errors
+        :param file_id: The upload id
+        :param part: The part index
+        :param total_parts: The number of parts of the file
+        :param data: The part content
+        :return: None
+        """
+        for attempt in range(1, self.retries + 1):
+            try:
+                if not await self.client(SaveBigFilePartRequest(file_id, part, total_parts, data)):
+                    raise ValueError(f"Part {part} refused")
+                return
+            except errors.FloodWaitError as err:
+                self.logging.warning(f"ParallelUploader - Flood wait of {err.seconds}s on part {part}")
+                PART_RETRIES.labels("flood_wait").inc()
+                await asyncio.sleep(err.seconds)
+            except (ConnectionError, ValueError, errors.RPCError) as err:
+                if attempt == self.retries:
+                    raise
+                self.logging.warning(f"ParallelUploader - Part {part} failed [{err}] - Retry {attempt}/{self.retries}")
+                PART_RETRIES.labels("error").inc()
+                await asyncio.sleep(attempt)
+        raise ConnectionError(f"Cannot upload part {part}")
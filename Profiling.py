@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+import collections
+import functools
+import inspect
+import os
+import sys
+import threading
+import time
+
+from Metrics import REGISTRY
+
+HANDLER_SECONDS = REGISTRY.histogram("giornalettiere_handler_seconds", "Time spent in each traced handler", ["handler"])
+
+# Durations kept for each traced handler, to summarize the recent calls
+TRACE_SAMPLES = 1000
+
+
+class HandlerTracer:
+    """
+    Measures the latency of the bot handlers and jobs.
+    Tracing replaces the handler callbacks with timed wrappers and disabling it puts the originals back,
+    so nothing is measured (nor paid) while it is off
+    """
+
+    def __init__(self, logging_handler):
+        """
+        Create the tracer
+        :param logging_handler: A logging instance
+        """
+        self.logging = logging_handler
+        self.swapped = []
+        self.durations = {}
+        self.errors = collections.Counter()
+
+    @property
+    def enabled(self):
+        return bool(self.swapped)
+
+    def enable(self, application, owner=None, methods=()):
+        """
+        Start tracing
+        :param application: The telegram Application whose handlers are traced
+        :param owner: The object owning the traced methods
+        :param methods: The names of further methods to trace (e.g. the scheduled jobs)
+        :return: False if the tracing was already enabled
+        """
+        if self.enabled:
+            return False
+        self.durations = {}
+        self.errors = collections.Counter()
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                self.swap(handler, "callback")
+        for method in methods:
+            self.swap(owner, method)
+        self.logging.info(f"HandlerTracer - Tracing {len(self.swapped)} handlers")
+        return True
+
+    def disable(self):
+        """
+        Stop tracing, restoring the original callbacks
+        :return: False if the tracing was not enabled
+        """
+        if not self.enabled:
+            return False
+        for target, attribute, original, own in reversed(self.swapped):
+            if own:
+                setattr(target, attribute, original)
+            else:
+                # The wrapper was shadowing a method of the class
+                delattr(target, attribute)
+        self.swapped = []
+        self.logging.info("HandlerTracer - Tracing disabled")
+        return True
+
+    def swap(self, target, attribute):
+        """
+        Replace a callable attribute with its timed wrapper
+        :param target: The object owning the attribute
+        :param attribute: The attribute name
+        :return: None
+        """
+        original = getattr(target, attribute)
+        # Objects without __dict__ (e.g. the handlers, using __slots__) always own their attributes
+        own = not hasattr(target, "__dict__") or attribute in vars(target)
+        setattr(target, attribute, self.wrap(getattr(original, "__name__", attribute), original))
+        self.swapped.append((target, attribute, original, own))
+
+    def wrap(self, name, function):
+        """
+        Build the timed wrapper of a function
+        :param name: The name used to report the function
+        :param function: The function, or coroutine function, to trace
+        :return: The wrapper
+        """
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def traced(*args, **kwargs):
+                start = time.perf_counter()
+                failed = True
+                try:
+                    result = await function(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    self.record(name, time.perf_counter() - start, failed)
+        else:
+            @functools.wraps(function)
+            def traced(*args, **kwargs):
+                start = time.perf_counter()
+                failed = True
+                try:
+                    result = function(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    self.record(name, time.perf_counter() - start, failed)
+        return traced
+
+    def record(self, name, duration, failed):
+        """
+        Record a traced call
+        :param name: The handler name
+        :param duration: The call duration in seconds
+        :param failed: True if the call raised an exception
+        :return: None
+        """
+        HANDLER_SECONDS.labels(name).observe(duration)
+        self.durations.setdefault(name, collections.deque(maxlen=TRACE_SAMPLES)).append(duration)
+        if failed:
+            self.errors[name] += 1
+        self.logging.info(f"HandlerTracer - {name} took {duration * 1000:.1f} ms{' (failed)' if failed else ''}")
+
+    def summary(self):
+        """
+        Summarize the calls traced since tracing was enabled
+        :return: One line for each traced handler
+        """
+        lines = []
+        for name in sorted(self.durations):
+            durations = sorted(self.durations[name])
+            p50 = durations[len(durations) // 2] * 1000
+            p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))] * 1000
+            lines.append(f"{name}: {len(durations)} calls, p50 {p50:.1f} ms, p95 {p95:.1f} ms, "
+                         f"max {durations[-1] * 1000:.1f} ms, {self.errors[name]} errors")
+        return lines
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all the threads of the process at a fixed interval, for a limited time.
+    The result is written in the folded stacks format read by flamegraph.pl and speedscope
+    """
+
+    def __init__(self, logging_handler, interval=0.01):
+        """
+        Create the profiler
+        :param logging_handler: A logging instance
+        :param interval: Seconds between two samples
+        """
+        self.logging = logging_handler
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.running = False
+
+    @staticmethod
+    def fold(frame, thread_name):
+        """
+        Describe a stack as a single line
+        :param frame: The innermost frame
+        :param thread_name: The name of the thread, used as root of the stack
+        :return: The frames from the root, separated by semicolons
+        """
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        frames.append(thread_name)
+        return ";".join(reversed(frames))
+
+    def run(self, duration, output_path):
+        """
+        Profile the process, blocking the calling thread
+        :param duration: Seconds to profile
+        :param output_path: The folded stacks file to write
+        :return: The number of samples taken, None if another profile is running
+        """
+        with self.lock:
+            if self.running:
+                return None
+            self.running = True
+        try:
+            self.logging.info(f"SamplingProfiler - Profiling for {duration}s")
+            stacks = collections.Counter()
+            me = threading.get_ident()
+            samples = 0
+            end = time.monotonic() + duration
+            while time.monotonic() < end:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident != me:
+                        stacks[self.fold(frame, names.get(ident, f"thread-{ident}"))] += 1
+                samples += 1
+                time.sleep(self.interval)
+            tmp_path = output_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            os.replace(tmp_path, output_path)
+            self.logging.info(f"SamplingProfiler - Written {samples} samples to [{output_path}]")
+            return samples
+        finally:
+            with self.lock:
+                self.running = False
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+import asyncio
+import os
+import time
+import uuid
+
+from DbConnector import DbConnector
+from Metrics import REGISTRY
+
+# Seconds given to the running uploads to end when the queue is stopped
+STOP_TIMEOUT = 10
+
+SETTLE_SECONDS = REGISTRY.histogram("giornalettiere_settle_seconds", "Time each file waited to stop changing before the upload")
+SETTLE_MISSING = REGISTRY.counter("giornalettiere_settle_missing_files_total", "Files disappeared while waiting for them")
+JOB_RETRIES = REGISTRY.counter("giornalettiere_upload_job_retries_total", "Uploads scheduled again after a failure")
+JOB_DEAD = REGISTRY.counter("giornalettiere_upload_job_dead_total", "Uploads given up, by reason", ["reason"])
+JOBS = REGISTRY.gauge("giornalettiere_upload_jobs", "Upload jobs in the queue, by state", ["state"])
+
+
+class UploadQueue:
+    """
+    The persistent queue of the files to upload, stored in the DB so that it survives restarts.
+    Each file moves through the states discovered -> stable -> uploading, and its job is deleted once it is sent,
+    or kept as failed once its attempts are over.
+    Uploading jobs are leased by this process and the lease is renewed while it runs, so the jobs of a crashed
+    process are taken again once their lease expires.
+    The workers wake up on new files, on completed uploads and on the next planned retry, without polling the DB
+    """
+
+    def __init__(self, db, stability_tracker, upload_scheduler, logging_handler, chat, on_sent=None,
+                 max_attempts=5, retry_backoff=30, max_retry_backoff=3600, lease=60, max_settle=86400, batch=100):
+        """
+        Create the queue
+        :param db: The DbConnector storing the jobs
+        :param stability_tracker: The StabilityTracker used to check that the discovered files are complete
+        :param upload_scheduler: The UploadScheduler sending the files
+        :param logging_handler: A logging instance
+        :param chat: The chat id the files are sent to
+        :param on_sent: Optional function called with the path of each file sent
+        :param max_attempts: Attempts made for each file before giving up
+        :param retry_backoff: Seconds waited after the first failed attempt, doubled after each further failure
+        :param max_retry_backoff: Maximum seconds waited between two attempts
+        :param lease: Seconds an upload is reserved to this process without being renewed
+        :param max_settle: Seconds a file can keep changing before giving up
+        :param batch: Maximum jobs read from the DB at once
+        """
+        self.db = db
+        self.stabilityTracker = stability_tracker
+        self.uploadScheduler = upload_scheduler
+        self.logging = logging_handler
+        self.chat = chat
+        self.onSent = on_sent
+        self.maxAttempts = max(1, int(max_attempts))
+        self.retryBackoff = retry_backoff
+        self.maxRetryBackoff = max_retry_backoff
+        self.lease = lease
+        self.maxSettle = max_settle
+        self.batch = batch
+        self.owner = uuid.uuid4().hex
+        self.claims = {}
+        self.tasks = []
+        self.discovered = None
+        self.ready = None
+        # A single query counts all the states at each collection
+        JOBS.set_collector(lambda: {(state,): count for state, count in self.backlog().items()})
+
+    def start(self):
+        """
+        Start the workers on the running event loop - The jobs left by a previous run are resumed
+        :return: None
+        """
+        self.owner = uuid.uuid4().hex
+        self.discovered = asyncio.Event()
+        self.ready = asyncio.Event()
+        self.discovered.set()
+        self.ready.set()
+        loop = asyncio.get_running_loop()
+        self.tasks = [
+            loop.create_task(self.settle_files(), name="settle"),
+            loop.create_task(self.uploadScheduler.upload(self.claim_files(), self.chat, on_result=self.finish),
+                             name="upload"),
+            loop.create_task(self.renew_leases(), name="lease"),
+        ]
+        self.logging.info(f"UploadQueue - Started - Jobs {self.db.countJobs()}")
+
+    async def stop(self):
+        """
+        Stop the workers - The interrupted uploads are resumed on the next start
+        :return: None
+        """
+        tasks, self.tasks = self.tasks, []
+        for task in tasks:
+            task.cancel()
+        # The upload task waits for the running uploads, and cancels them once the time is over
+        if tasks:
+            await asyncio.wait(tasks, timeout=STOP_TIMEOUT)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Release the leased files at once, instead of waiting for their lease to expire - The attempt is not counted
+        now = time.time()
+        for name, attempt in self.claims.values():
+            self.db.releaseJob(name, self.owner, now)
+        self.claims = {}
+        self.logging.info("UploadQueue - Stopped")
+
+    def discover(self, files):
+        """
+        Queue new files - Must be called from the event loop
+        :param files: The paths of the files to upload
+        :return: The number of files queued
+        """
+        queued = self.db.discoverJobs([(os.path.basename(path), path) for path in files], time.time())
+        if queued:
+            self.logging.info(f"UploadQueue - Queued {queued} new files")
+            if self.discovered is not None:
+                self.discovered.set()
+        return queued
+
+    def retry_failed(self):
+        """
+        Queue again the files given up - Must be called from the event loop
+        :return: The number of files queued
+        """
+        queued = self.db.retryFailedJobs(time.time())
+        if queued and self.discovered is not None:
+            self.discovered.set()
+        return queued
+
+    def backlog(self):
+        """
+        :return: The number of jobs in each state
+        """
+        counts = self.db.countJobs()
+        return {state: counts.get(state, 0) for state in DbConnector.JOB_STATES}
+
+    async def settle_files(self):
+        """
+        Move the discovered files to the stable state once they stop changing
+        :return: None
+        """
+        while True:
+            jobs = self.db.getJobs(DbConnector.JOB_DISCOVERED, self.batch)
+            if not jobs:
+                self.discovered.clear()
+                await self.discovered.wait()
+                continue
+            start = time.monotonic()
+            paths = {path: (name, discovered_at) for name, path, discovered_at in jobs}
+            stable, missing = await asyncio.to_thread(self.stabilityTracker.poll, list(paths))
+            now = time.time()
+            for path in missing:
+                self.logging.warning(f"UploadQueue - File missing [{path}] - Skipping it")
+                self.db.removeJob(paths[path][0])
+            SETTLE_MISSING.inc(len(missing))
+            if stable:
+                self.db.markJobsStable([paths[path][0] for path in stable], now)
+                for path in stable:
+                    SETTLE_SECONDS.observe(max(0.0, now - paths[path][1]))
+                self.ready.set()
+            done = set(stable).union(missing)
+            given_up = []
+            for path, (name, discovered_at) in paths.items():
+                if path not in done and now - discovered_at > self.maxSettle:
+                    self.logging.error(f"UploadQueue - File still changing after {self.maxSettle}s [{path}] - Given up")
+                    self.db.failJob(name, "File never stopped changing", now)
+                    JOB_DEAD.labels("unstable").inc()
+                    given_up.append(path)
+            if given_up:
+                self.stabilityTracker.forget(given_up)
+                done.update(given_up)
+            if len(done) < len(paths):
+                # Files still being written are sampled again after the settle interval
+                await asyncio.sleep(max(0.0, self.stabilityTracker.settleInterval - (time.monotonic() - start)))
+
+    async def claim_files(self):
+        """
+        Lease the files ready to upload as they become available
+        :return: An async iterator over the paths of the leased files
+        """
+        while True:
+            self.ready.clear()
+            now = time.time()
+            jobs = self.db.claimJobs(self.owner, now, now + self.lease, self.batch)
+            for name, path, attempt in jobs:
+                self.claims[path] = (name, attempt)
+                yield path
+            if jobs:
+                continue
+            due = self.db.nextJobDue(self.owner)
+            try:
+                await asyncio.wait_for(self.ready.wait(), None if due is None else max(0.0, due - time.time()))
+            except TimeoutError:
+                pass
+
+    def finish(self, result):
+        """
+        Record the outcome of an upload
+        :param result: The UploadResult
+        :return: None
+        """
+        name, attempt = self.claims.pop(result.file_path, (os.path.basename(result.file_path), self.maxAttempts))
+        now = time.time()
+        if result.delivered:
+            self.db.completeJob(name, self.owner)
+            if self.onSent:
+                self.onSent(result.file_path)
+        elif not os.path.exists(result.file_path):
+            self.logging.warning(f"UploadQueue - File disappeared [{result.file_path}]")
+            self.db.removeJob(name, self.owner)
+        elif attempt >= self.maxAttempts:
+            self.logging.error(f"UploadQueue - Cannot deliver [{result.file_path}] after {attempt} attempts - Given up")
+            self.db.failJob(name, result.error or "Not delivered", now, self.owner)
+            JOB_DEAD.labels("attempts").inc()
+        else:
+            delay = min(self.maxRetryBackoff, self.retryBackoff * 2 ** (attempt - 1))
+            self.logging.warning(f"UploadQueue - Cannot deliver [{result.file_path}] - Attempt {attempt}/{self.maxAttempts}, "
+                                 f"retrying in {delay}s")
+            self.db.retryJob(name, self.owner, now + delay, result.error or "Not delivered", now)
+            JOB_RETRIES.inc()
+            # The planned retry may come before the time the claimer is waiting for
+            self.ready.set()
+
+    async def renew_leases(self):
+        """
+        Keep the leases of the jobs held by this process
+        :return: None
+        """
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            self.db.renewLeases(self.owner, time.time() + self.lease)
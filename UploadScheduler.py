@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import asyncio
+import itertools
+import math
+import os
+import time
+
+from Metrics import REGISTRY
+
+UPLOAD_SECONDS = REGISTRY.histogram("giornalettiere_upload_seconds", "Time spent sending each file", ["lane"])
+UPLOADS = REGISTRY.counter("giornalettiere_uploads_total", "Files sent, by outcome", ["lane", "outcome"])
+UPLOAD_BYTES = REGISTRY.counter("giornalettiere_upload_bytes_total", "Bytes of the files delivered", ["lane"])
+UPLOAD_QUEUED = REGISTRY.gauge("giornalettiere_upload_queued_files", "Files waiting for a free upload worker", ["lane"])
+UPLOAD_ACTIVE = REGISTRY.gauge("giornalettiere_upload_active_files", "Files being sent", ["lane"])
+
+
+class UploadResult:
+    """
+    The outcome of a single upload
+    """
+
+    def __init__(self, file_path, lane, delivered, duration=0.0, error=None):
+        self.file_path = file_path
+        self.lane = lane
+        self.delivered = delivered
+        self.duration = duration
+        self.error = error
+
+    def __repr__(self):
+        status = "delivered" if self.delivered else f"failed [{self.error}]"
+        return f"UploadResult({self.file_path}, {self.lane}, {status}, {self.duration:.2f}s)"
+
+
+class UploadScheduler:
+    """
+    Uploads files concurrently on two separate lanes: the Bot API lane for small files
+    and the MTProto lane for big ones. Each lane has its own bounded parallelism
+    and sends the smallest files queued first
+    """
+
+    BOT_LANE = "bot"
+    MTPROTO_LANE = "mtproto"
+
+    def __init__(self, small_sender, big_sender, logging_handler, max_small_size,
+                 small_workers=4, big_workers=1, only_big=False):
+        """
+        Create the scheduler
+        :param small_sender: Coroutine function (file_path, message, chat) sending through the Bot API - Returns True if delivered
+        :param big_sender: Coroutine function (file_path, message, chat) sending through MTProto - Returns True if delivered
+        :param logging_handler: A logging instance
+        :param max_small_size: Files of this size (bytes) or bigger use the MTProto lane
+        :param small_workers: Maximum concurrent uploads on the Bot API lane
+        :param big_workers: Maximum concurrent uploads on the MTProto lane
+        :param only_big: Send every file through the MTProto lane
+        """
+        self.logging = logging_handler
+        self.maxSmallSize = max_small_size
+        self.onlyBig = only_big
+        self.lanes = {
+            self.BOT_LANE: (small_sender, max(1, int(small_workers))),
+            self.MTPROTO_LANE: (big_sender, max(1, int(big_workers))),
+        }
+
+    def choose_lane(self, size):
+        """
+        Select the lane for a file
+        :param size: The file size in bytes
+        :return: The lane name
+        """
+        if self.onlyBig or size >= self.maxSmallSize:
+            return self.MTPROTO_LANE
+        return self.BOT_LANE
+
+    async def upload(self, files, chat, message="", on_result=None):
+        """
+        Upload the given files
+        :param files: An iterable (or async iterable) of files to send, consumed as they become available
+        :param chat: The chat id the files will be sent to
+        :param message: The message to send with each file
+        :param on_result: Optional function called with each UploadResult as soon as it is available
+        :return: The list of UploadResult
+        """
+        results = []
+        order = itertools.count()
+        queues = {lane: asyncio.PriorityQueue() for lane in self.lanes}
+
+        def report(result):
+            results.append(result)
+            self.logging.info(f"UploadScheduler - {result}")
+            if on_result:
+                on_result(result)
+
+        async def worker(lane):
+            sender = self.lanes[lane][0]
+            queue = queues[lane]
+            while True:
+                size, _, file_path = await queue.get()
+                if file_path is None:
+                    return
+                UPLOAD_QUEUED.labels(lane).dec()
+                UPLOAD_ACTIVE.labels(lane).inc()
+                start = time.monotonic()
+                try:
+                    delivered, error = bool(await sender(file_path, message, chat)), None
+                except Exception as err:
+                    delivered, error = False, err
+                finally:
+                    UPLOAD_ACTIVE.labels(lane).dec()
+                duration = time.monotonic() - start
+                UPLOAD_SECONDS.labels(lane).observe(duration)
+                UPLOADS.labels(lane, "delivered" if delivered else "failed").inc()
+                if delivered:
+                    UPLOAD_BYTES.labels(lane).inc(size)
+                report(UploadResult(file_path, lane, delivered, duration, error))
+
+        workers = [asyncio.create_task(worker(lane))
+                   for lane, (_, count) in self.lanes.items() for _ in range(count)]
+        try:
+            async for file_path in self.iterate(files):
+                try:
+                    size = os.path.getsize(file_path)
+                except OSError as err:
+                    report(UploadResult(file_path, None, False, error=err))
+                    continue
+                lane = self.choose_lane(size)
+                UPLOAD_QUEUED.labels(lane).inc()
+                await queues[lane].put((size, next(order), file_path))
+        finally:
+            # Stop markers are sorted after every queued file
+            for lane, (_, count) in self.lanes.items():
+                for _ in range(count):
+                    queues[lane].put_nowait((math.inf, next(order), None))
+            await asyncio.gather(*workers)
+        return results
+
+    @staticmethod
+    async def iterate(files):
+        """
+        Iterate over both plain and async iterables
+        :param files: The iterable
+        :return: An async iterator
+        """
+        if hasattr(files, '__aiter__'):
+            async for item in files:
+                yield item
+        else:
+            for item in files:
+                yield item
@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmarks of the bot hot paths, run offline against local stand-ins:
+
+- scan: check_new_files on a synthetic fileLocation tree (100k files in deep directories)
+- scrape / scrape_streaming: GiornalettiereDownloader on synthetic listing and post pages served by a local HTTP server
+- upload: send_small_document through the upload scheduler against a local fake Bot API,
+  then the same files again to measure the uploads sent by reference
+
+Each stage runs in its own process, so that its peak RSS is measured alone.
+The inputs are generated from a fixed seed, so runs on the same machine can be compared over time.
+
+Usage: python benchmarks/run_benchmarks.py [--stages scan upload] [--files 100000] [--seed 1] [--output results.json]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+STAGES = ["scan", "scrape", "scrape_streaming", "upload"]
+
+# The words used to compose the synthetic titles
+WORDS = ["italy", "legge", "tasse", "news", "gazzetta", "sport", "finanza", "meteo", "cronaca", "politica",
+         "economia", "cultura", "scienza", "salute", "motori", "viaggi", "cinema", "musica", "libri", "tech"]
+
+# The options passed to the process of each stage
+FORWARDED_OPTIONS = ["seed", "rounds", "files", "depth", "fanout", "new_files", "posts", "links", "padding",
+                     "uploads", "upload_latency", "log_level"]
+
+BOT_TOKEN = "123456:BENCHMARK"
+CHANNEL = "@benchmark"
+DOWNLOAD_REQUEST = "MyFiles"
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile
+    :param values: The measured values
+    :param p: The percentile (0-100)
+    :return: The percentile, 0 if there are no values
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+def summarize(stage, operations, unit, seconds, latencies, **extra):
+    """
+    Build the result of a stage
+    :param stage: The stage name
+    :param operations: The number of items processed
+    :param unit: The unit of the items (e.g. "files")
+    :param seconds: The time spent processing the items
+    :param latencies: The latency of each measured operation, in seconds
+    :param extra: Further values to report
+    :return: The result dictionary
+    """
+    return {
+        "stage": stage,
+        "operations": operations,
+        "seconds": round(seconds, 4),
+        "throughput": round(operations / seconds, 2) if seconds else 0.0,
+        "unit": unit + "/s",
+        "latency_ms": {f"p{p}": round(percentile(latencies, p) * 1000, 3) for p in (50, 95, 99)},
+        "samples": len(latencies),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "extra": extra,
+    }
+
+
+def make_config(file_location, bot_api_url=""):
+    """
+    The bot settings used by the benchmarks
+    :param file_location: The directory of the downloaded files
+    :param bot_api_url: The URL of the fake Bot API
+    :return: The configuration dictionary
+    """
+    return {
+        "Telegram": {
+            "telegram_token": BOT_TOKEN,
+            "apiId": 12345,
+            "apiHash": "0123456789abcdef0123456789abcdef",
+            "myChannel": CHANNEL,
+            "botApiUrl": bot_api_url,
+        },
+        "Download": {
+            "filetypes": ["pdf"],
+            "dailyChecksAt": [],
+            "fileLocation": file_location,
+            "downloadRequest": DOWNLOAD_REQUEST,
+            "downloadSite": "http://127.0.0.1:9/",
+        },
+    }
+
+
+def make_bot(work_dir, bot_api_url=""):
+    """
+    Create a bot whose state is kept in a scratch directory
+    :param work_dir: The scratch directory
+    :param bot_api_url: The URL of the fake Bot API
+    :return: The Giornalettiere instance
+    """
+    from Giornalettiere import Giornalettiere
+    settings_dir = os.path.join(work_dir, "Settings")
+    config_dir = os.path.join(work_dir, "DownloadConfig")
+    os.makedirs(settings_dir, exist_ok=True)
+    os.makedirs(config_dir, exist_ok=True)
+    return Giornalettiere(make_config(os.path.join(work_dir, "downloads"), bot_api_url), logging, settings_dir, config_dir)
+
+
+def start_server(handler):
+    """
+    Serve on a free local port from a daemon thread
+    :param handler: The request handler class
+    :return: The tuple (server, base url)
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class QuietFileHandler(SimpleHTTPRequestHandler):
+    """
+    Static file handler that does not log every request on stderr
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    """
+    Minimal Bot API answering getMe and sendDocument with valid objects
+    """
+
+    protocol_version = "HTTP/1.1"
+    latency = 0.0
+    counter = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        # The whole upload is read, as a real server would
+        remaining = int(self.headers.get("Content-Length", 0))
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 1 << 20)))
+        method = self.path.rsplit("/", 1)[-1]
+        if self.latency:
+            time.sleep(self.latency)
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+        elif method == "sendDocument":
+            with self.lock:
+                FakeBotApiHandler.counter += 1
+                message_id = FakeBotApiHandler.counter
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": -1001234567890, "type": "channel", "title": "Benchmark"},
+                "document": {"file_id": f"BQAC{message_id:08d}", "file_unique_id": f"AgAD{message_id:08d}"},
+            }
+        else:
+            result = True
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def generate_tree(root, rng, files, depth, fanout, extensions):
+    """
+    Create a tree of empty files
+    :param root: The tree root
+    :param rng: The random generator
+    :param files: The number of files to create
+    :param depth: The depth of the tree
+    :param fanout: The subdirectories of each directory
+    :param extensions: The file extensions, the first one is the searched one
+    :return: The list of directories
+    """
+    directories = [root]
+    level = [root]
+    for _ in range(depth):
+        level = [os.path.join(parent, f"d{i}") for parent in level for i in range(fanout)]
+        directories.extend(level)
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+    add_files(directories, rng, files, extensions, "f")
+    return directories
+
+
+def add_files(directories, rng, files, extensions, prefix):
+    """
+    Create empty files in random directories
+    :param directories: The candidate directories
+    :param rng: The random generator
+    :param files: The number of files to create
+    :param extensions: The file extensions, the first one is the searched one
+    :param prefix: The file names prefix
+    :return: None
+    """
+    for i in range(files):
+        # 80% of the files have the searched extension
+        extension = extensions[0] if rng.random() < 0.8 else rng.choice(extensions[1:])
+        open(os.path.join(rng.choice(directories), f"{prefix}{i:07d}{extension}"), "w").close()
+
+
+def run_scan(args, work_dir):
+    """
+    Full scan of a big tree, then incremental scans after a few new files
+    """
+    rng = random.Random(args.seed)
+    giorna = make_bot(work_dir)
+    extensions = [".pdf", ".part", ".tmp", ".epub"]
+    directories = generate_tree(giorna.scanner.root, rng, args.files, args.depth, args.fanout, extensions)
+
+    start = time.perf_counter()
+    new_files = giorna.check_new_files()
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    giorna.add_to_file_list([os.path.basename(path) for path in new_files])
+    record = time.perf_counter() - start
+
+    latencies = []
+    for round_number in range(args.rounds):
+        add_files(directories, rng, args.new_files, extensions, f"r{round_number:03d}_")
+        start = time.perf_counter()
+        found = giorna.check_new_files()
+        latencies.append(time.perf_counter() - start)
+        giorna.add_to_file_list([os.path.basename(path) for path in found])
+    giorna.db.close()
+    return summarize("scan", args.files, "files", cold, latencies,
+                     directories=len(directories), new_files=len(new_files),
+                     record_seconds=round(record, 4), incremental_new_files=args.new_files)
+
+
+def generate_site(site_dir, base_url, rng, posts, links, padding):
+    """
+    Create a listing page and its post pages, with the structure of DownloadConfig/template.toml.example
+    :param site_dir: The site directory
+    :param base_url: The site URL, used by the listing links
+    :param rng: The random generator
+    :param posts: The number of posts in the listing
+    :param links: The number of download links in each post
+    :param padding: Bytes of unrelated content following the download section of each post
+    :return: None
+    """
+    today = date.today().strftime("%d.%m.%Y")
+    items = []
+    for post in range(posts):
+        items.append(
+            f'<a class="news" href="{base_url}/post{post}.html"><div class="div-img"><div class="div-date">{today}</div></div>'
+            f'<div class="div-text"><h2>Post {post} {" ".join(rng.sample(WORDS, 3))}</h2></div></a>')
+        anchors = []
+        for link in range(links):
+            title = " ".join(rng.sample(WORDS, 4)) + f" {post}-{link}"
+            anchors.append(f'<a href="https://files.example.org/{post}/{link}.pdf">{title}</a>')
+        filler = "<p>" + "lorem ipsum dolor sit amet " * (padding // 27) + "</p>"
+        with open(os.path.join(site_dir, f"post{post}.html"), "w", encoding="iso-8859-1") as f:
+            f.write(f'<html><body><div id="div-content"><div class="div-item">{"".join(anchors)}</div></div>'
+                    f'{filler}</body></html>')
+    with open(os.path.join(site_dir, "list.html"), "w") as f:
+        f.write(f'<html><body><div id="main-content">{"".join(items)}</div></body></html>')
+
+
+def make_download_config(base_url, streaming, keywords):
+    """
+    The download configuration of the synthetic site
+    :param base_url: The site URL
+    :param streaming: Parse the pages while downloading them
+    :param keywords: The relevant content
+    :return: The configuration dictionary
+    """
+    return {
+        "name": "Benchmark",
+        "domains": [base_url + "/"],
+        "query": "list.html",
+        "relevantContent": keywords,
+        "Crawl": {"workers": 4, "per_domain": 4, "delay": 0},
+        "List": {
+            "relevant_date": "today",
+            "key_containing_date": "date",
+            "streaming": streaming,
+            "search_steps": [{"attribute": "id", "name": "main-content"}],
+            "search_element": {
+                "element": {"attribute": "class", "name": "news", "type": "a"},
+                "extract": [
+                    {"key": "url", "value": "href"},
+                    {"key": "date", "value": "text", "steps": [
+                        {"attribute": "class", "name": "div-img", "type": "div"},
+                        {"attribute": "class", "name": "div-date", "type": "div"},
+                    ]},
+                    {"key": "title", "value": "text", "steps": [
+                        {"attribute": "class", "name": "div-text", "type": "div"},
+                        {"type": "h2"},
+                    ]},
+                ],
+            },
+        },
+        "Download": {
+            "host": ["files.example.org"],
+            "page_encoding": "iso-8859-1",
+            "streaming": streaming,
+            "search_steps": [
+                {"attribute": "id", "name": "div-content"},
+                {"attribute": "class", "name": "div-item", "type": "div"},
+            ],
+            "search_element": {
+                "element": {"type": "a"},
+                "extract": [{"key": "title", "value": "text"}, {"key": "url", "value": "href"}],
+            },
+        },
+    }
+
+
+def run_scrape(args, work_dir, streaming=False):
+    """
+    Repeated searches on the synthetic site - The first one fills the page cache
+    """
+    from ExtractionPlan import HTML_PARSER
+    from GiornalettiereDownloader import GiornalettiereDownloader
+    rng = random.Random(args.seed)
+    site_dir = os.path.join(work_dir, "site")
+    os.makedirs(site_dir)
+    server, base_url = start_server(partial(QuietFileHandler, directory=site_dir))
+    generate_site(site_dir, base_url, rng, args.posts, args.links, args.padding)
+    downloader = GiornalettiereDownloader(logging, make_download_config(base_url, streaming, rng.sample(WORDS, 8)),
+                                          os.path.join(work_dir, "http_cache"))
+    latencies = []
+    found = 0
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        found = len(downloader.extractRelevantLinks())
+        latencies.append(time.perf_counter() - start)
+    downloader.http.close()
+    server.shutdown()
+    pages = (args.posts + 1) * args.rounds
+    return summarize("scrape_streaming" if streaming else "scrape", pages, "pages", sum(latencies), latencies,
+                     parser=HTML_PARSER, posts=args.posts, links_per_post=args.links, links_selected=found,
+                     first_search_ms=round(latencies[0] * 1000, 3))
+
+
+def run_upload(args, work_dir):
+    """
+    Upload of new files, then of the same files again (sent by reference)
+    """
+    rng = random.Random(args.seed)
+    FakeBotApiHandler.latency = args.upload_latency / 1000
+    server, base_url = start_server(FakeBotApiHandler)
+    giorna = make_bot(work_dir, base_url)
+    upload_dir = os.path.join(work_dir, "uploads")
+    os.makedirs(upload_dir)
+    files = []
+    total_bytes = 0
+    for i in range(args.uploads):
+        # Sizes spread log-uniformly between 16KiB and 4MiB
+        size = int(2 ** rng.uniform(14, 22))
+        path = os.path.join(upload_dir, f"upload{i:05d}.pdf")
+        with open(path, "wb") as f:
+            f.write(rng.randbytes(size))
+        files.append(path)
+        total_bytes += size
+
+    async def upload_all():
+        await giorna.bot.initialize()
+        try:
+            passes = []
+            for _ in range(2):
+                start = time.perf_counter()
+                results = await giorna.uploadScheduler.upload(list(files), CHANNEL)
+                passes.append((time.perf_counter() - start, results))
+            return passes
+        finally:
+            await giorna.bot.shutdown()
+
+    (seconds, results), (cached_seconds, cached_results) = asyncio.run(upload_all())
+    giorna.db.close()
+    server.shutdown()
+    failed = sum(1 for result in results + cached_results if not result.delivered)
+    return summarize("upload", len(files), "files", seconds, [result.duration for result in results],
+                     megabytes_per_second=round(total_bytes / seconds / 2 ** 20, 2) if seconds else 0.0,
+                     total_mb=round(total_bytes / 2 ** 20, 1), failed=failed,
+                     workers=giorna.localParameters['Telegram']['smallUploadWorkers'],
+                     cached_throughput=round(len(files) / cached_seconds, 2) if cached_seconds else 0.0,
+                     cached_p95_ms=round(percentile([r.duration for r in cached_results], 95) * 1000, 3))
+
+
+def run_stage(args):
+    """
+    Run a single stage in this process and write its result
+    :param args: The parsed arguments
+    :return: None
+    """
+    with tempfile.TemporaryDirectory(prefix=f"giornalettiere-{args.run_stage}-") as work_dir:
+        logging.basicConfig(filename=os.path.join(work_dir, "benchmark.log"), level=args.log_level,
+                            format='%(asctime)s %(levelname)-8s %(message)s')
+        if args.run_stage == "scan":
+            result = run_scan(args, work_dir)
+        elif args.run_stage == "scrape":
+            result = run_scrape(args, work_dir)
+        elif args.run_stage == "scrape_streaming":
+            result = run_scrape(args, work_dir, streaming=True)
+        else:
+            result = run_upload(args, work_dir)
+        logging.shutdown()
+    with open(args.result_file, "w") as f:
+        json.dump(result, f)
+
+
+def print_table(results):
+    """
+    Print the results of all the stages
+    :param results: The stage results
+    :return: None
+    """
+    print(f"{'stage':<18}{'ops':>9}{'throughput':>20}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}{'peak RSS MB':>13}")
+    for result in results:
+        latency = result["latency_ms"]
+        throughput = f"{result['throughput']:.1f} {result['unit']}"
+        print(f"{result['stage']:<18}{result['operations']:>9}{throughput:>20}"
+              f"{latency['p50']:>11.2f}{latency['p95']:>11.2f}{latency['p99']:>11.2f}{result['peak_rss_mb']:>13.1f}")
+        for key, value in result["extra"].items():
+            print(f"{'':<18}{key} = {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the Giornalettiere hot paths")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="The stages to run")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the synthetic inputs")
+    parser.add_argument("--rounds", type=int, default=20, help="Repetitions of the measured operation")
+    parser.add_argument("--files", type=int, default=100000, help="scan - Files in the synthetic tree")
+    parser.add_argument("--depth", type=int, default=6, help="scan - Depth of the synthetic tree")
+    parser.add_argument("--fanout", type=int, default=4, help="scan - Subdirectories of each directory")
+    parser.add_argument("--new-files", type=int, default=50, help="scan - Files added before each incremental scan")
+    parser.add_argument("--posts", type=int, default=50, help="scrape - Posts in the listing page")
+    parser.add_argument("--links", type=int, default=200, help="scrape - Download links in each post")
+    parser.add_argument("--padding", type=int, default=100000, help="scrape - Bytes following the links of each post")
+    parser.add_argument("--uploads", type=int, default=100, help="upload - Files uploaded")
+    parser.add_argument("--upload-latency", type=float, default=0, help="upload - Milliseconds added to each Bot API call")
+    parser.add_argument("--log-level", default="INFO", help="Level of the bot logs, written in the scratch directory")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--run-stage", choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        run_stage(args)
+        return
+
+    results = []
+    # Each child runs a single stage with the same options
+    forwarded = []
+    for option in FORWARDED_OPTIONS:
+        forwarded += ["--" + option.replace("_", "-"), str(getattr(args, option))]
+    for stage in args.stages:
+        with tempfile.NamedTemporaryFile(suffix=".json") as result_file:
+            print(f"Running [{stage}]...", flush=True)
+            subprocess.run([sys.executable, os.path.realpath(__file__), *forwarded,
+                            "--run-stage", stage, "--result-file", result_file.name], check=True)
+            with open(result_file.name) as f:
+                results.append(json.load(f))
+    print_table(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "seed": args.seed,
+                "results": results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,15 +2,18 @@
 import sys
 import os
 import logging
-import time
 import tomllib
 from datetime import datetime, timedelta
 
-import schedule
-import threading
 from Giornalettiere import Giornalettiere
 from DirectoryWatcher.DirectoryWatcher import DirectoryWatcher
 
+# The directory events that trigger a channel update
+WATCHED_EVENTS = ['IN_CREATE', 'IN_MOVED_TO', 'IN_CLOSE_WRITE']
+
+# Seconds between two checks that the directory watcher is still alive
+WATCHER_CHECK_INTERVAL = 1
+
 
 # Check if the given path is an absolute path
 def create_absolute_path(path):
@@ -20,25 +23,13 @@ def create_absolute_path(path):
 		
 	return path
 
-# Used to run scheduled task as threads
-def run_threaded(job_func):
-	job_thread = threading.Thread(target=job_func)
-	job_thread.start()
-
-
-def run_bot(watcher, watched_dir, logging, giorna):
-	while 1:
-		try:
-			time.sleep(1)
-			schedule.run_pending()
-			if not watcher.is_alive():
-				logging.warning("DirectoryWatcher is dead, restarting")
-				watcher = DirectoryWatcher(giorna.update_channel, logging)
-				watcher.watch_this_directory(watched_dir, ['IN_CREATE', 'IN_MOVED_TO'])
-				watcher.start()
-		except Exception as err:
-			logging.exception(f"Unexpected error during bot execution - Stop bot [{err}]")
-			exit(1)
+# Start watching the download directory - The watcher only reads the directory events, updates run on the bot event loop
+def start_watcher(watched_dir, logging, giorna):
+	watcher = DirectoryWatcher(giorna.request_update, logging, giorna.stabilityTracker, giorna.localParameters['Download']['watcherDebounce'])
+	watcher.watch_this_directory(watched_dir, WATCHED_EVENTS)
+	watcher.daemon = True
+	watcher.start()
+	return watcher
 
 def calculate_new_time(start_time_str, delay_minutes):
 	start_time = datetime.strptime(start_time_str, "%H:%M")
@@ -78,30 +69,34 @@ def main():
 	if len(sys.argv) > 1 and sys.argv[1] == 'systemd':
 		logging.info("Started by systemd using argument: "+sys.argv[1])
 
-	# Schedule actions
+	# Schedule actions - Jobs run on the bot event loop once it is started
+	# The methods are looked up on each run, so that they can be traced on demand
 	delay = config["Download"].get("recheckDelay", 0)
 	for selected_time in config['Download']['dailyChecksAt']:
 		try:
-			schedule.every().day.at(str(selected_time)).do(run_threaded, giorna.fetch_data)
+			giorna.scheduler.every_day_at(selected_time, lambda: giorna.fetch_data_async(), "fetch_data@" + str(selected_time))
 			logging.info("Setting daily check at: "+str(selected_time))
 			if delay:
 				manual_recheck = calculate_new_time(selected_time, delay)
-				schedule.every().day.at(manual_recheck).do(run_threaded, giorna.sync_update_channel)
+				giorna.scheduler.every_day_at(manual_recheck, lambda: giorna.update_channel(), "update_channel@" + manual_recheck)
 				logging.info("Planned manual recheck at: " + str(manual_recheck))
-		except schedule.ScheduleValueError as e:
+		except ValueError as e:
 			logging.error("Cannot set a scheduled run at ["+str(selected_time)+"]: "+str(e))
 			exit()
 
 	# Add notifier
 	try:
 		watched_dir = os.path.join(config['Download']['fileLocation'], config['Download']['downloadRequest'])
-		watcher = DirectoryWatcher(giorna.update_channel, logging)
-		watcher.watch_this_directory(watched_dir, ['IN_CREATE', 'IN_MOVED_TO'])
-		watcher.start()
+		watcher = start_watcher(watched_dir, logging, giorna)
 		logging.info("Created notifier successfully")
 
-		thread = threading.Thread(target=run_bot, args=(watcher, watched_dir, logging, giorna))
-		thread.start()
+		async def check_watcher():
+			nonlocal watcher
+			if not watcher.is_alive():
+				logging.warning("DirectoryWatcher is dead, restarting")
+				watcher = start_watcher(watched_dir, logging, giorna)
+
+		giorna.scheduler.every(WATCHER_CHECK_INTERVAL, check_watcher, "check_watcher")
 		logging.info("Started scheduler")
 
 		# Start bot